@@ -9,16 +9,43 @@ import json
 import sqlite3
 import webbrowser
 import time
+import random
+import zlib
+import hashlib
+import os
+import atexit
+import socket
+import argparse
+import contextlib
+import threading
+import queue
+import gc
+import tracemalloc
+import tempfile
+from collections import deque, OrderedDict
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial
 import secrets # file that contains API keys
 
 # parsing
+import re
+import html
 import bs4
 from bs4 import BeautifulSoup
 from string import punctuation, digits 
+try: # optional, only needed for --extractor lxml
+    import lxml.html
+except ImportError:
+    lxml = None
 
 # authorization
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
 from oauthlib.oauth2 import BackendApplicationClient
 from requests_oauthlib import OAuth2Session
 
@@ -42,23 +69,613 @@ client_key = secrets.KROGER_CLIENT_ID # from secrets
 client_secret = secrets.KROGER_CLIENT_SECRET # from secrets
 redirect = secrets.REDIRECT_URI # from secrets
 
+# RESULTS
+RESULTS_DB = "recipe.sqlite" # parsed recipes, override with --results-db, crawl workers on several machines share one file
+
 # CACHE
-CACHE_FILE_NAME = "cache_recipes.json"
+CACHE_DB = "cache.sqlite" # recipe, search and Kroger cache entries, one row per key
+CACHE_FILE_NAME = "cache_recipes.json" # before cache.sqlite, migrated into it once
 CACHE_DICT = {}
+CACHE_MAX_AGE = 7 * 24 * 60 * 60 # seconds before a cached recipe page is revalidated
+CACHE_LOCK = threading.Lock() # guards CACHE_STATS, updated from several threads
+CACHE_STATS = {} # hit/miss counters (e.g. {"recipe hit": 12}), see count_cache
+CACHE_FLUSH_INTERVAL = 2 # seconds between background writes of new cache entries
+CACHE_PRUNE_INTERVAL = 60 * 60 # seconds between deleting expired entries from cache.sqlite
+CACHE_TTL = {"recipes": 90 * 24 * 60 * 60, "parsed": 90 * 24 * 60 * 60, "kroger": 24 * 60 * 60} # seconds an entry lives: prices and stock change, recipes rarely do
+CACHE_MAX_ENTRIES = 2000 # entries per cache kept in memory, override with --cache-entries
+CACHE_MAX_BYTES = 64 * 1024 * 1024 # compressed bytes per cache kept in memory, override with --cache-bytes
+CACHE_BODY_FIELD = {"recipes": "text"} # stored once per distinct page content
+FLUSH_CACHES = [] # SQLiteCaches written by the flusher
+FLUSH_JSON = {} # JSON cache files waiting to be written, file name: dict
+FLUSH_LOCK = threading.Lock()
+FLUSHER = None
+
+# OFFLINE: serve everything from the cache, set with --offline
+OFFLINE = False
+
+# CONCURRENCY
+MAX_WORKERS = 8 # recipe pages fetched at the same time, override with --workers
+QUERY_DEADLINE = 10 # seconds to wait for a query's recipes before showing what is ready, override with --deadline
+RECIPE_EXECUTOR = None # shared pool, outlives a query so late recipes can still finish
+
+# PARSING: 0 parses in the fetch threads, more hands the HTML to a process pool, override with --parse-workers
+PARSE_WORKERS = 0
+PARSE_EXECUTOR = None
+EXTRACTOR = "soup" # how recipe pages are parsed, "soup" (BeautifulSoup) or "lxml", override with --extractor
+USE_JSONLD = True # read the page's schema.org JSON-LD when it has one, turn off with --no-jsonld
+EXTRACTOR_VERSION = 2 # bump when parse_recipe_html changes, so parsed records cached by older code are redone
+PARSED_DICT = {} # url: fields extracted from the page, see get_recipe_instance
+RECIPE_FIELDS = ["name", "rating", "num_rating", "directions", "num_steps", "review", "num_review", "servings", "ingredients", "nutrition"]
+
+# INGREDIENTS: words removed to turn "2 cups flour, sifted" into "flour", see IngredientNormalizer
+# stopwords were derived from looking at many recipes
+INGREDIENT_STOPWORDS = ["teaspoons", "teaspoon", "tablespoons", "tablespoon", "ounces", "ounce", 
+    "fluid ounces", "fluid ounce", "gills", "gill", "cups", "cup", "pints", "pint",  "quarts",
+    "quart", "gallons", "gallon", "pounds", "pound", "grams", "gram", "packages", "package", 
+    "canned", "cans", "can", "inches", "inch", "crumbs", "crumb", "cubes", "cube", "warm", "cold", 
+    "hot", "chilled", "refrigerated", "container", "packed", "pack", "finely", "fine", "chopped",
+    "instant", "mix", "room temperature", "diced", "sliced", "uncooked", "optional", "mashed",
+    "peeled", "bulk", "pureed", "frozen", "ground", "dried", "minced", "cooked", "to", "taste",
+    "boxes", "such", "as", "large", "small", "sheets", "grated", "pinch", "sifted", "lightly", 
+    "light", "dark", "medium", "fresh", "jar", "boxed", "coarsely", "rinsed", "bunch", "freshly",
+    "as", "needed", "bag", "roughly", "very", "thinly", "thin", "cubed", "piece", "matchsticks",
+    "grated", "part", "just", "ripe", "raw", "sprigs", "stalks", "stalk", "store-bought", "serving", 
+    "crushed", "whole", "drained", "sprigs", "sprig", "for", "decoration", "dash", "box", "dry", 
+    "large", "drizzling", "carton", "stalk", "soaked", "granules", "trimmed", "head", "milliliter",
+    "peel", "leaves", "prepared", "garnish", "superfine", "crumbles", "topping"] 
+INGREDIENT_PUNCTUATION = ["(", ")", "."] # always removed, also from inside words
+INGREDIENT_MEMO_SIZE = 50000 # normalized ingredient lines remembered
+
+# CRAWL QUEUE: shared work queue for crawling many queries from several processes or machines
+CRAWL_DB = "crawl_queue.sqlite" # override with --queue-db, put it on storage every worker can reach
+CRAWL_LEASE = 300 # seconds a worker owns an item before others may take it over
+CRAWL_MAX_ATTEMPTS = 3 # leases per item before it is marked failed
+CRAWL_IDLE_WAIT = 5 # seconds to wait when other workers still hold leases
+
+# SEARCH: results pages read per query, override with --pages and --target
+SEARCH_PAGES = 1
+SEARCH_WORKERS = 4 # results pages fetched at the same time
+SEARCH_EXECUTOR = None
+SEARCH_CACHE_TTL = 24 * 60 * 60 # seconds a cached list of search results is used, override with --search-ttl
+
+# HTTP SESSIONS: one keep-alive session per host, reused for the whole run
+ALLRECIPES_HOST = "www.allrecipes.com"
+KROGER_HOST = "api.kroger.com"
+POOL_MAXSIZE = {ALLRECIPES_HOST: MAX_WORKERS + SEARCH_WORKERS, KROGER_HOST: 4} # open connections kept per host, one per thread using it
+POOL_MAXSIZE_DEFAULT = 2
+SESSIONS = {}
+SESSION_LOCK = threading.Lock()
+KROGER_OAUTH = None # authorized Kroger session, reused across queries
+KROGER_CLIENT_OAUTH = None # client credentials session for product lookups without a user
+KROGER_TOKEN_LOCK = threading.Lock() # one client credentials token request at a time
+KROGER_EXECUTOR = None # product lookups, as many threads as pooled Kroger connections
+
+# REQUEST POLICY: applied to every outbound call
+REQUEST_TIMEOUT = (3.05, 20) # (connect, read) seconds
+RETRY_ATTEMPTS = 3 # extra tries for GETs only, other methods are not idempotent
+RETRY_BACKOFF = 0.5 # seconds, doubled on every retry and jittered
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+BREAKER_THRESHOLD = 5 # failures in a row before a host is cut off
+BREAKER_RESET = 30 # seconds before a cut off host gets one trial request
+BREAKERS = {}
+
+# RATE LIMITS: token bucket per host, rate adapts AIMD-style to throttling
+RATE_START = {ALLRECIPES_HOST: 4.0, KROGER_HOST: 4.0} # requests per second to begin with
+RATE_MAX = {ALLRECIPES_HOST: 16.0, KROGER_HOST: 8.0}
+RATE_START_DEFAULT = 2.0
+RATE_MAX_DEFAULT = 4.0
+RATE_MIN = 0.25
+RATE_INCREASE = 1.0 # about +1 request per second for every second of healthy responses
+RATE_DECREASE = 0.5 # rate is multiplied by this when throttled
+THROTTLE_STATUSES = [429, 503]
+LIMITERS = {}
 
 # KROGER CACHE
-CACHE_FILE_K = "cache_kroger.json"
+CACHE_FILE_K = "cache_kroger.json" # before cache.sqlite, migrated into it once
 CACHE_DICT_K = {}
+KROGER_PRODUCT_FIELDS = ["upc", "brand", "categories", "description"] # all that Product and the cart read, see compact_kroger_payload
 
 # SECRET CACHE: for the refreshable tokens
 CACHE_FILE_S = "cache_secret.json" # tokens will expire, but still should not be shared
 CACHE_DICT_S = {}
 
+class CacheMissError(Exception):
+    '''Raised in offline mode when a page is not in the cache.'''
+    pass
+
+class CircuitOpenError(Exception):
+    '''Raised when a host has failed too often and is being skipped.'''
+    pass
+
+class CircuitBreaker:
+    '''Failure counter for one host. After BREAKER_THRESHOLD failures
+    in a row, requests fail fast until BREAKER_RESET seconds have passed;
+    then a single trial request decides whether the host is back.
+
+    Instance Attributes
+    -------------------
+    host: string
+        the host being guarded (e.g. "www.allrecipes.com")
+    failures: int
+        failures in a row
+    opened_at: float or None
+        time the breaker opened, None while closed
+    '''
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < BREAKER_RESET:
+                raise CircuitOpenError(self.host + " is failing, skipping request")
+            self.opened_at = time.time() # half open: let this one request through, hold back the rest
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= BREAKER_THRESHOLD:
+                self.opened_at = time.time()
+
+class RateLimiter:
+    '''Token bucket for one host. Every request takes a token; tokens
+    refill at the current rate. Healthy responses raise the rate a
+    little (additive increase), 429/503 halve it (multiplicative
+    decrease) and a Retry-After pauses the host.
+
+    Instance Attributes
+    -------------------
+    host: string
+        the host being paced (e.g. "www.allrecipes.com")
+    rate: float
+        current requests per second
+    max_rate: float
+        the rate never goes above this
+    tokens: float
+        requests that can go out right now
+    paused_until: float
+        time before which no request goes out (from Retry-After)
+    '''
+    def __init__(self, host):
+        self.host = host
+        self.rate = RATE_START.get(host, RATE_START_DEFAULT)
+        self.max_rate = RATE_MAX.get(host, RATE_MAX_DEFAULT)
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate) # burst of at most one second
+                self.updated = now
+                if now < self.paused_until:
+                    wait_time = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time) # sleep without holding the lock
+
+    def record_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE / self.rate)
+
+    def record_throttle(self, retry_after=None):
+        with self.lock:
+            self.rate = max(RATE_MIN, self.rate * RATE_DECREASE)
+            self.tokens = 0.0
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.time() + retry_after)
+
+    def current_rate(self):
+        return self.rate
+
+class SQLiteCache:
+    '''Cache stored as one SQLite row per key, so reading or writing
+    an entry costs the same however big the cache is. Several caches
+    (namespaces) can share one database file. Supports the dict
+    operations the program uses: in, [], get and assignment.
+
+    Writes are held in memory (dirty) and written in one transaction by
+    flush(), which the background flusher calls every
+    CACHE_FLUSH_INTERVAL seconds and at exit; reads see them right away.
+
+    Entries are stored as zlib-compressed JSON. If body_field is set,
+    that field (e.g. a page's html) is split off and stored once per
+    distinct content in the shared cache_bodies table, keyed by its
+    hash. Entries read from the database are kept, still compressed,
+    in an LRU of at most max_entries entries and max_bytes bytes, and
+    only decompressed when they are used. Entries older than ttl
+    seconds count as missing and are deleted by prune().
+
+    Instance Attributes
+    -------------------
+    db_path: string
+        the database file (e.g. "cache.sqlite")
+    namespace: string
+        which cache this is (e.g. "recipes", "kroger")
+    ttl: float or None
+        seconds an entry lives, None keeps it forever
+    max_entries: int
+        most entries kept in memory
+    max_bytes: int
+        most compressed bytes of entries kept in memory
+    body_field: string or None
+        field of the entries stored content-addressed (e.g. "text")
+    json_file: string or None
+        old JSON cache file copied in the first time the cache is opened
+    upgrade: function or None
+        applied once to every stored entry when opened, and to the
+        entries copied from json_file (e.g. to drop unused fields)
+    dirty: dict
+        key: (value, stored time) not written to the database yet
+    memory: OrderedDict
+        key: (compressed value, compressed body, size, stored time), least recently used first
+    stats: dict
+        counters of "memory hits", "disk hits", "misses", "expired" and "evictions"
+    '''
+    def __init__(self, db_path, namespace, ttl=None, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, body_field=None, json_file=None, upgrade=None):
+        self.db_path = db_path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.body_field = body_field
+        self.json_file = json_file
+        self.upgrade = upgrade
+        self.dirty = {}
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.stats = {"memory hits": 0, "disk hits": 0, "misses": 0, "expired": 0, "evictions": 0}
+        self.lock = threading.Lock()
+        self.open_lock = threading.RLock()
+        self.ready = False
+        self.conn = None # opened by open() on first use, so startup doesn't wait on the database
+        self.orphans = set() # hashes of bodies whose rows were replaced, checked by the next prune
+
+    def open(self):
+        '''Connect to the database the first time the cache is used:
+        create the tables, copy in json_file once, compress rows from
+        before compression once and delete expired entries. Until
+        then, opening the cache costs nothing, however big it is.'''
+        if self.ready:
+            return
+        with self.open_lock:
+            if self.conn is not None: # already open, or being opened by this thread
+                return
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=60) # shared by the fetch threads, guarded by lock
+            with self.lock, self.conn:
+                self.conn.execute("PRAGMA journal_mode=WAL") # readers don't wait for the writer
+                self.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS "cache" (
+                        "namespace" TEXT NOT NULL,
+                        "key" TEXT NOT NULL,
+                        "value" BLOB NOT NULL,
+                        "stored_at" REAL NOT NULL DEFAULT 0,
+                        "body_hash" TEXT,
+                        "size" INTEGER NOT NULL DEFAULT 0,
+                        PRIMARY KEY ("namespace", "key")
+                    );
+                ''')
+                self.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS "cache_bodies" (
+                        "hash" TEXT PRIMARY KEY NOT NULL,
+                        "data" BLOB NOT NULL
+                    );
+                ''')
+                self.conn.execute('''
+                    CREATE TABLE IF NOT EXISTS "cache_meta" (
+                        "key" TEXT PRIMARY KEY NOT NULL,
+                        "value" TEXT NOT NULL
+                    );
+                ''')
+                columns = [row[1] for row in self.conn.execute("PRAGMA table_info(cache)")]
+                if "stored_at" not in columns: # cache.sqlite from before TTLs, entries start their TTL now
+                    self.conn.execute("ALTER TABLE cache ADD COLUMN stored_at REAL NOT NULL DEFAULT 0")
+                    self.conn.execute("UPDATE cache SET stored_at = ?", (time.time(),))
+                if "body_hash" not in columns: # cache.sqlite from before compression, see compress_old_rows
+                    self.conn.execute("ALTER TABLE cache ADD COLUMN body_hash TEXT")
+                    self.conn.execute("ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+                self.conn.execute('CREATE INDEX IF NOT EXISTS "cache_stored_at" ON "cache" ("namespace", "stored_at")') # prune without a table scan
+                self.conn.execute('CREATE INDEX IF NOT EXISTS "cache_body_hash" ON "cache" ("body_hash")') # is a body still used
+            if self.json_file is not None:
+                marker = "migrated " + self.json_file
+                if self.get_meta(marker) is None:
+                    old_entries = load_cache(self.json_file)
+                    if self.upgrade is not None:
+                        old_entries = {key: self.upgrade(value) for key, value in old_entries.items()}
+                    self.update({key: value for key, value in old_entries.items() if key not in self.dirty}) # don't undo writes made before opening
+                    self.flush() # one transaction, however big the file
+                    self.set_meta(marker, str(time.time()))
+            if self.get_meta("compressed " + self.namespace) is None:
+                self.compress_old_rows()
+                self.set_meta("compressed " + self.namespace, str(time.time()))
+            if self.upgrade is not None:
+                marker = "upgraded " + self.namespace + " " + self.upgrade.__name__
+                if self.get_meta(marker) is None:
+                    self.upgrade_rows()
+                    self.set_meta(marker, str(time.time()))
+            self.prune()
+            self.ready = True
+
+    def expired(self, stored_at):
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def decode(self, value_blob, body_blob):
+        '''Turn a stored entry back into its value.'''
+        if type(value_blob) == str: # plain JSON row from before compression
+            return json.loads(value_blob)
+        value = json.loads(zlib.decompress(value_blob))
+        if body_blob is not None:
+            value[self.body_field] = zlib.decompress(body_blob).decode("utf-8")
+        return value
+
+    def encode(self, value):
+        '''Compress an entry for storage and add its body to
+        cache_bodies if that content is not stored yet. Call with lock
+        held, inside a transaction.
+
+        Returns
+        -------
+        tuple
+            (compressed value, body hash or None, uncompressed size)
+        '''
+        size = len(json.dumps(value))
+        body_hash = None
+        if self.body_field is not None and type(value) == dict and type(value.get(self.body_field)) == str:
+            body = value[self.body_field].encode("utf-8")
+            body_hash = hashlib.sha1(body).hexdigest()
+            if self.conn.execute("SELECT 1 FROM cache_bodies WHERE hash = ?", (body_hash,)).fetchone() is None: # same page content is stored once
+                self.conn.execute("INSERT INTO cache_bodies (hash, data) VALUES (?, ?)", (body_hash, zlib.compress(body)))
+            value = dict(value)
+            del value[self.body_field]
+        return zlib.compress(json.dumps(value).encode("utf-8")), body_hash, size
+
+    def remember(self, key, value_blob, body_blob, stored_at):
+        '''Put a compressed entry in the in-memory LRU and evict the
+        least recently used entries until it fits. Call with lock held.'''
+        if key in self.memory:
+            self.memory_bytes -= self.memory.pop(key)[2]
+        size = len(value_blob) + len(body_blob or b"")
+        self.memory[key] = (value_blob, body_blob, size, stored_at)
+        self.memory_bytes += size
+        while len(self.memory) > self.max_entries or (self.memory_bytes > self.max_bytes and len(self.memory) > 1):
+            evicted = self.memory.popitem(last=False)[1]
+            self.memory_bytes -= evicted[2]
+            self.stats["evictions"] += 1
+
+    def lookup(self, key):
+        '''Find an entry, returning (found, value). Call with lock held.'''
+        if key in self.dirty:
+            return True, self.dirty[key][0]
+        if key in self.memory:
+            value_blob, body_blob, size, stored_at = self.memory[key]
+            if not self.expired(stored_at):
+                self.memory.move_to_end(key)
+                self.stats["memory hits"] += 1
+                return True, self.decode(value_blob, body_blob)
+            self.memory_bytes -= self.memory.pop(key)[2]
+            self.stats["expired"] += 1
+            return False, None
+        row = self.conn.execute('''
+            SELECT cache.value, cache.stored_at, cache_bodies.data FROM cache
+            LEFT JOIN cache_bodies ON cache_bodies.hash = cache.body_hash
+            WHERE cache.namespace = ? AND cache.key = ?
+        ''', (self.namespace, key)).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return False, None
+        if self.expired(row[1]):
+            self.stats["expired"] += 1
+            return False, None
+        self.remember(key, row[0], row[2], row[1])
+        self.stats["disk hits"] += 1
+        return True, self.decode(row[0], row[2])
+
+    def __contains__(self, key):
+        self.open()
+        with self.lock:
+            if key in self.dirty or key in self.memory: # no need to decompress to answer
+                return key in self.dirty or not self.expired(self.memory[key][3])
+            row = self.conn.execute("SELECT stored_at FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)).fetchone()
+        return row is not None and not self.expired(row[0])
+
+    def __getitem__(self, key):
+        self.open()
+        with self.lock:
+            found, value = self.lookup(key)
+        if not found:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def update(self, entries, stored_at=None):
+        '''Queue several entries for the next flush.'''
+        if stored_at is None:
+            stored_at = time.time()
+        with self.lock:
+            for key, value in entries.items():
+                self.dirty[key] = (value, stored_at)
+
+    def flush(self):
+        '''Write the queued entries in one transaction. A crash loses
+        at most the entries of one interval, never the file.'''
+        if len(self.dirty) == 0:
+            return
+        self.open()
+        with self.lock:
+            if len(self.dirty) == 0:
+                return
+            with self.conn:
+                for key, (value, stored_at) in self.dirty.items():
+                    value_blob, body_hash, size = self.encode(value)
+                    if self.body_field is not None:
+                        old = self.conn.execute("SELECT body_hash FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key)).fetchone()
+                        if old is not None and old[0] is not None and old[0] != body_hash:
+                            self.orphans.add(old[0])
+                    self.conn.execute('''
+                        INSERT OR REPLACE INTO cache (namespace, key, value, stored_at, body_hash, size)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (self.namespace, key, value_blob, stored_at, body_hash, size))
+            for key in self.dirty: # drop older copies from the LRU
+                if key in self.memory:
+                    self.memory_bytes -= self.memory.pop(key)[2]
+            self.dirty = {}
+
+    def compress_old_rows(self):
+        '''Rewrite the rows stored as plain JSON before compression.
+
+        Returns
+        -------
+        int
+            number of rows rewritten
+        '''
+        self.open()
+        with self.lock, self.conn:
+            rows = self.conn.execute("SELECT key, value FROM cache WHERE namespace = ? AND typeof(value) = 'text'", (self.namespace,)).fetchall()
+            for key, text in rows:
+                value_blob, body_hash, size = self.encode(json.loads(text))
+                self.conn.execute("UPDATE cache SET value = ?, body_hash = ?, size = ? WHERE namespace = ? AND key = ?", (value_blob, body_hash, size, self.namespace, key))
+        return len(rows)
+
+    def upgrade_rows(self):
+        '''Rewrite every stored entry through upgrade, then give the
+        freed space back to the file system.
+
+        Returns
+        -------
+        int
+            number of rows rewritten
+        '''
+        self.open()
+        self.flush()
+        with self.lock:
+            with self.conn:
+                rows = self.conn.execute('''
+                    SELECT cache.key, cache.value, cache_bodies.data, cache.body_hash FROM cache
+                    LEFT JOIN cache_bodies ON cache_bodies.hash = cache.body_hash
+                    WHERE cache.namespace = ?
+                ''', (self.namespace,)).fetchall()
+                for key, value_blob, body_blob, old_hash in rows:
+                    value_blob, body_hash, size = self.encode(self.upgrade(self.decode(value_blob, body_blob)))
+                    if old_hash is not None and old_hash != body_hash:
+                        self.orphans.add(old_hash)
+                    self.conn.execute("UPDATE cache SET value = ?, body_hash = ?, size = ? WHERE namespace = ? AND key = ?", (value_blob, body_hash, size, self.namespace, key))
+            self.memory.clear()
+            self.memory_bytes = 0
+            self.conn.execute("VACUUM") # can't run inside a transaction
+        return len(rows)
+
+    def prune(self):
+        '''Delete the entries older than ttl from the database, and the
+        page bodies of deleted or replaced entries that no entry uses
+        anymore. Only looks at those rows and bodies, through indexes,
+        so it costs nothing when nothing expired.
+
+        Returns
+        -------
+        int
+            number of entries deleted
+        '''
+        self.open()
+        with self.lock, self.conn:
+            deleted = 0
+            if self.ttl is not None:
+                cutoff = time.time() - self.ttl
+                expired = self.conn.execute("SELECT DISTINCT body_hash FROM cache WHERE namespace = ? AND stored_at < ? AND body_hash IS NOT NULL", (self.namespace, cutoff))
+                self.orphans.update(row[0] for row in expired)
+                deleted = self.conn.execute("DELETE FROM cache WHERE namespace = ? AND stored_at < ?", (self.namespace, cutoff)).rowcount
+            for body_hash in self.orphans: # bodies can be shared, only delete the unused ones
+                self.conn.execute("DELETE FROM cache_bodies WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM cache WHERE body_hash = ?)", (body_hash, body_hash))
+            self.orphans = set()
+        return deleted
+
+    def get_stats(self):
+        '''Counters plus the current size of the in-memory LRU.'''
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory entries"] = len(self.memory)
+            stats["memory bytes"] = self.memory_bytes
+        return stats
+
+    def compression_report(self):
+        '''How much smaller this cache is on disk than uncompressed.
+        Bodies shared with other entries are counted for each entry in
+        "raw bytes" but once in "stored bytes".
+
+        Returns
+        -------
+        dict
+            "raw bytes", "stored bytes" and their "ratio"
+        '''
+        self.open()
+        self.flush()
+        with self.lock:
+            raw, stored = self.conn.execute("SELECT COALESCE(SUM(size), 0), COALESCE(SUM(LENGTH(value)), 0) FROM cache WHERE namespace = ?", (self.namespace,)).fetchone()
+            stored += self.conn.execute('''
+                SELECT COALESCE(SUM(LENGTH(data)), 0) FROM cache_bodies
+                WHERE hash IN (SELECT body_hash FROM cache WHERE namespace = ?)
+            ''', (self.namespace,)).fetchone()[0]
+        ratio = 0
+        if stored > 0:
+            ratio = round(raw / stored, 1)
+        return {"raw bytes": raw, "stored bytes": stored, "ratio": ratio}
+
+    def keys(self):
+        '''Every key stored in this cache, expired or not.'''
+        self.open()
+        self.flush()
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT key FROM cache WHERE namespace = ?", (self.namespace,))]
+
+    def __len__(self):
+        self.open()
+        self.flush()
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM cache WHERE namespace = ?", (self.namespace,)).fetchone()[0]
+
+    def get_meta(self, key):
+        self.open()
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cache_meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, key, value):
+        self.open()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO cache_meta (key, value) VALUES (?, ?)", (key, value))
+
 class Recipe:
-    '''A recipe from allrecipes.com
+    '''A recipe from allrecipes.com. Only holds the extracted values
+    (in __slots__, no per-instance __dict__), never the page itself.
 
     Instance Attributes
     -------------------
+    url: string
+        the recipe page (e.g. "https://www.allrecipes.com/recipe/17481/simple-white-cake/")
     name: string
         the name of a recipe (e.g. "Chocolate Cake')
     rating: float or int
@@ -87,6 +704,8 @@ class Recipe:
         the nutritional information of a recipe (e.g. "412 calories; protein 6.8g...", "")
         some nutritional information is blank
     '''
+    __slots__ = ["url"] + RECIPE_FIELDS
+
     # Class constants to parse HTML
     NAME_DIV_CLASS = "headline-wrapper"
     NAME_CONTAINER_TAG = "h1"
@@ -121,12 +740,22 @@ class Recipe:
         self.ingredients = self.extract_ingredients(details_soup)
         self.nutrition = self.extract_nutrition(details_soup)
 
+    @classmethod
+    def from_record(cls, url, record):
+        '''Make a recipe from a dict of already extracted fields
+        (see parse_recipe_html) without parsing any HTML.'''
+        recipe = cls.__new__(cls)
+        recipe.url = url
+        for field in RECIPE_FIELDS:
+            setattr(recipe, field, record[field])
+        return recipe
+
     def extract_name(self, soup):
         nam = (soup.find(class_=self.NAME_DIV_CLASS)
         .find(self.NAME_CONTAINER_TAG)
         .next_element
         .string)
-        return nam
+        return str(nam) # plain string, a NavigableString would keep the whole soup alive
 
     def extract_rating(self, soup):
         try: # use try/catch in case rating is missing
@@ -262,7 +891,8 @@ class Recipe:
         return str(self.name) + " (" + str(self.num_steps) + " Steps): " + str(self.rating) + " Stars"
 
 class Product():
-    '''Product within Kroger.
+    '''Product within Kroger. Attributes are in __slots__, there is
+    no per-instance __dict__.
 
     Instance Attributes
     ----------
@@ -278,8 +908,10 @@ class Product():
     limit: int
         The return limit of the product
     json: json dict
-        The json result for the product
+        The json result for the product, only read, not kept
     '''
+    __slots__ = ["upc", "brand", "categories", "description", "limit"]
+
     def __init__(self, upc="No upc", brand="No brand", categories="No categories", description="No description", limit="No limit value", json="None"):
         if json == "None":
             self.upc = upc
@@ -310,8 +942,15 @@ class Product():
             except (IndexError, KeyError):
                 self.limit = None
 
+def connect_results_db():
+    '''Open RESULTS_DB. Crawl workers may share the file, so writers
+    wait for each other instead of failing. It keeps SQLite's default
+    rollback journal: WAL needs shared memory, which network
+    filesystems don't provide.'''
+    return sqlite3.connect(RESULTS_DB, timeout=60)
+
 def create_tables():
-    conn = sqlite3.connect("recipe.sqlite")
+    conn = connect_results_db()
     cur = conn.cursor()
 
     create_recipes = '''
@@ -367,7 +1006,7 @@ def create_tables():
     conn.commit()
 
 def add_to_recipe_table(recipe_data_list):
-    conn = sqlite3.connect("recipe.sqlite")
+    conn = connect_results_db()
     cur = conn.cursor()
     insert_recipes = '''
         INSERT OR IGNORE INTO recipes
@@ -378,7 +1017,7 @@ def add_to_recipe_table(recipe_data_list):
     conn.commit()
 
 def add_to_ingredients_table(ingredients_data_list):
-    conn = sqlite3.connect("recipe.sqlite")
+    conn = connect_results_db()
     cur = conn.cursor()
     insert_ingredients = '''
         INSERT OR IGNORE INTO ingredients
@@ -389,7 +1028,7 @@ def add_to_ingredients_table(ingredients_data_list):
     conn.commit()
 
 def add_to_reviews_table(reviews_data_list):
-    conn = sqlite3.connect("recipe.sqlite")
+    conn = connect_results_db()
     cur = conn.cursor()
     insert_reviews = '''
         INSERT OR IGNORE INTO reviews
@@ -400,7 +1039,7 @@ def add_to_reviews_table(reviews_data_list):
     conn.commit()
 
 def add_to_cart_list_table(cart_data_list):
-    conn = sqlite3.connect("recipe.sqlite")
+    conn = connect_results_db()
     cur = conn.cursor()
     insert_cart = '''
         INSERT OR IGNORE INTO cart
@@ -409,26 +1048,140 @@ def add_to_cart_list_table(cart_data_list):
     cur.execute(insert_cart, cart_data_list)
     conn.commit()
 
+def store_recipe(recipe, query, url):
+    '''Add a recipe to the recipes, ingredients and reviews tables.
+
+    Parameters
+    ----------
+    recipe: instance
+        a recipe instance
+    query: string
+        the recipe query the recipe was found with
+    url: string
+        the URL for the recipe page
+
+    Returns
+    -------
+    None
+    '''
+    ### add recipe info to the database
+    rec_list = []
+    rec_list.append(str(recipe.name))
+    rec_list.append(query)
+    rec_list.append(url)
+    rec_list.append(int(recipe.num_steps))
+
+    # directions edge case
+    directions_str = "" # create a list so the string doesn't get weird going/coming from the db
+    if recipe.directions == "No Directions":
+         directions_str += str(recipe.directions) + "; "
+    else:
+        for d in recipe.directions:
+            directions_str += str(d) + "; " # so that I can split the lists by ";" later
+    directions_str = directions_str[:-2] # to get rid of the last "; "
+    rec_list.append(directions_str) 
+        
+    rec_list.append(str(recipe.rating))
+    rec_list.append(str(recipe.num_rating))
+    add_to_recipe_table(rec_list) # creates a table in database
+
+    ### add ingredient info to the database
+    ingr_list = []
+    ingr_list.append(str(recipe.name))
+    ingr_list.append(query)
+
+    ingredients_str = "" # create a list so the string doesn't get weird going/coming from the db
+    for i in recipe.ingredients:
+        ingredients_str += str(i) + "; " # so that I can split the lists by ";" later
+    ingredients_str = ingredients_str[:-2] # to get rid of the last "; "
+    ingr_list.append(ingredients_str)
+
+    ingr_list.append(int(recipe.servings))
+
+    # nutrition edge case
+    nutrition_str = "" # create a list so the string doesn't get weird going/coming from the db
+    if recipe.nutrition == "No nutrition information":
+         nutrition_str += str(recipe.nutrition) + "; "
+    else:
+        for n in recipe.nutrition:
+            nutrition_str += str(n) + "; " # so that I can split the lists by ";" later
+    nutrition_str = nutrition_str[:-2] # to get rid of the last "; "
+    ingr_list.append(nutrition_str) 
+
+    add_to_ingredients_table(ingr_list) # creates a table in database
+
+    ### add review info to the database
+    rev_list = []
+    rev_list.append(str(recipe.name))
+    rev_list.append(query)
+
+    # review edge case
+    review_str = "" # create a list so the string doesn't get weird going/coming from the db
+    if recipe.review == "No reviews":
+         review_str += str(recipe.review) + "; "
+    else:
+        for r in recipe.review:
+            review_str += str(r) + "; " # so that I can split the lists by ";" later
+    review_str = review_str[:-2] # to get rid of the last "; "
+    rev_list.append(review_str) 
+
+    rev_list.append(str(recipe.num_review))
+    add_to_reviews_table(rev_list) # creates a table in database
+
+def store_cart_products(kroger_products, parsed_ingredient_list, ingredients):
+    '''Add the Kroger products found for a recipe to the cart table.
+
+    Parameters
+    ----------
+    kroger_products: list
+        /v1/products json results, one per search term
+    parsed_ingredient_list: list
+        the search terms used (e.g. "flour")
+    ingredients: list
+        the recipe's raw ingredients
+
+    Returns
+    -------
+    None
+    '''
+    for kp in range(len(kroger_products)):
+        k = kroger_products[kp]
+        p  = parsed_ingredient_list[kp]
+        product = Product(json=k)
+        shop_list = []
+
+        # Kroger related items
+        shop_list.append(str(product.upc))
+        shop_list.append(p)
+        shop_list.append(str(ingredients))
+        shop_list.append(str(product.brand))
+        shop_list.append(str(product.categories))
+        shop_list.append(str(product.description))
+        shop_list.append(product.limit)
+        add_to_cart_list_table(shop_list) # creates a table in database
+
 def pull_from_db(query):
-    conn = sqlite3.connect("recipe.sqlite")
+    conn = connect_results_db()
     cur = conn.cursor()
     # sub in query from main
     result = cur.execute(query).fetchall()
     conn.close()
     return result
 
-def build_recipe_url_dict():
-    ''' Make a dictionary that maps recipe name to recipe page url from "https://www.allrecipes.com/"
+def build_search_url(query, page=1):
+    '''Make the allrecipes.com search results url for a query.
 
     Parameters
     ----------
-    None
+    query: string
+        the recipe query (e.g. "chocolate cake")
+    page: int
+        results page, starting at 1
 
     Returns
     -------
-    dict
-        key is a recipe name and value is the url
-        e.g. {"cake": ["https://www.allrecipes.com/recipe/25642/white-chocolate-raspberry-cheesecake/", ...}
+    string
+        the url of the results page
     '''
     BASE_URL = "https://www.allrecipes.com/search/results/" 
  
@@ -436,31 +1189,42 @@ def build_recipe_url_dict():
     special = "%20" # after the first word append "%20" to the beginning of each word
     empty_query = ""
 
-    if len(recipe_query) > 1:
-        r = recipe_query.split()
+    if len(query) > 1:
+        r = query.split()
         empty_query += r[0]
         for i in range(1, len(r)):
             j = special + r[i]
             empty_query += j
     
     else: 
-        empty_query = recipe_query
+        empty_query = query
 
     # create params dictionary
     params = {}
     params["wt"] = empty_query
     params["sort"] = "p" # sort by popular recipes
+    if page > 1: # page 1 keeps the original url
+        params["page"] = page
 
     param_strings = []
     for k in params:
         param_strings.append("{}={}".format(k, params[k]))
-    recipe_page_url = BASE_URL + "?" + "&".join(param_strings)
+    return BASE_URL + "?" + "&".join(param_strings)
 
-    # BeautifulSoup parsing
-    response = requests.get(recipe_page_url, headers=headers)
-    soup = BeautifulSoup(response.text, "html.parser") # Make the soup
-    recipes = {}
-    
+def parse_search_page(page_text):
+    '''Find the recipe urls on a search results page.
+
+    Parameters
+    ----------
+    page_text: string
+        html of the results page
+
+    Returns
+    -------
+    list
+        recipe urls in the order they appear
+    '''
+    soup = BeautifulSoup(page_text, "html.parser") # Make the soup
     recipes_query_list = [] 
     recipe_list_parent = soup.find_all("div", id="searchResultsApp") # to parse recipe list for crawling
     for tag in recipe_list_parent:
@@ -472,8 +1236,284 @@ def build_recipe_url_dict():
                     linkdata = recipe_link.get("href")
                     if linkdata[:34] == "https://www.allrecipes.com/recipe/":
                         recipes_query_list.append(linkdata)
-    recipes[recipe_query] = recipes_query_list      
-    return recipes
+    return recipes_query_list
+
+def normalize_query(query):
+    '''Lower case a query and collapse its whitespace, so that
+    "Chocolate  cake " and "chocolate cake" share a cache entry.'''
+    return " ".join(query.lower().split())
+
+def fetch_search_page(query, page):
+    '''Return the recipe urls on one search results page. The parsed
+    url list is cached in CACHE_DICT under the page url for
+    SEARCH_CACHE_TTL seconds, so a repeated query skips both the
+    download and the parse. Only a 200 page is cached, an error page
+    (e.g. 403 or 404) is tried again next time.
+
+    Parameters
+    ----------
+    query: string
+        the recipe query
+    page: int
+        results page, starting at 1
+
+    Returns
+    -------
+    list
+        recipe urls in the order they appear
+    '''
+    search_url = build_search_url(normalize_query(query), page)
+    entry = CACHE_DICT.get(search_url)
+    if entry is not None:
+        if OFFLINE or time.time() - entry["fetched"] < SEARCH_CACHE_TTL:
+            count_cache("search hit")
+            return entry["urls"]
+        count_cache("search stale")
+    elif OFFLINE:
+        raise CacheMissError(query)
+    else:
+        count_cache("search miss")
+
+    response = send_request("GET", search_url)
+    urls = parse_search_page(response.text)
+    if response.status_code == 200:
+        CACHE_DICT[search_url] = {"urls": urls, "fetched": time.time()}
+    return urls
+
+def iter_recipe_urls(query, pages=SEARCH_PAGES, target=None):
+    '''Yield recipe urls for a query, most popular first. The results
+    pages are downloaded at the same time, urls are yielded as soon as
+    their page (and every page before it) is in, and a url that shows
+    up on more than one page is yielded once.
+
+    Parameters
+    ----------
+    query: string
+        the recipe query
+    pages: int
+        the most results pages to read
+    target: int or None
+        stop after this many urls, None reads every page
+
+    Yields
+    ------
+    string
+        recipe url
+    '''
+    if OFFLINE and build_search_url(normalize_query(query), 1) not in CACHE_DICT: # fall back to the urls saved for this query in the database
+        query_urls = "SELECT url FROM recipes WHERE query = ? ORDER BY rowid"
+        conn = connect_results_db()
+        urls = parse_single_from_db(conn.execute(query_urls, (query,)).fetchall())
+        conn.close()
+        if len(urls) == 0:
+            raise CacheMissError(query)
+        yield from urls[:target]
+        return
+
+    executor = get_search_executor()
+    futures = [executor.submit(fetch_search_page, query, page) for page in range(1, pages + 1)]
+    seen = set()
+    try:
+        for future in futures: # in page order, so popularity order is kept
+            try:
+                page_urls = future.result()
+            except CacheMissError: # offline and this page was never cached, stop here
+                return
+            if len(page_urls) == 0: # ran out of results, later pages are empty too
+                return
+            for url in page_urls:
+                if url in seen:
+                    continue
+                seen.add(url)
+                yield url
+                if target is not None and len(seen) >= target:
+                    return
+    finally:
+        for future in futures: # stopped early, don't download the rest
+            future.cancel()
+
+### HTTP SESSIONS ###
+def configure_session(session, host):
+    '''Mount a connection pool sized for the host on a session
+    and apply the shared request headers.
+
+    Parameters
+    ----------
+    session: requests.Session
+        the session to configure (OAuth2Session is a Session too)
+    host: string
+        the host the session talks to (e.g. "www.allrecipes.com")
+
+    Returns
+    -------
+    requests.Session
+        the same session
+    '''
+    pool_size = POOL_MAXSIZE.get(host, POOL_MAXSIZE_DEFAULT)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(headers)
+    return session
+
+def get_session(url):
+    '''Return the shared session for the host of a url, creating it
+    the first time the host is seen.
+
+    Parameters
+    ----------
+    url: string
+        the url about to be requested
+
+    Returns
+    -------
+    requests.Session
+        keep-alive session for the url's host
+    '''
+    host = urlparse(url).netloc
+    with SESSION_LOCK: # worker threads may ask for a session at the same time
+        if host not in SESSIONS:
+            SESSIONS[host] = configure_session(requests.Session(), host)
+        return SESSIONS[host]
+
+def get_breaker(host):
+    '''Return the circuit breaker for a host.'''
+    with SESSION_LOCK:
+        if host not in BREAKERS:
+            BREAKERS[host] = CircuitBreaker(host)
+        return BREAKERS[host]
+
+def get_limiter(host):
+    '''Return the rate limiter for a host.'''
+    with SESSION_LOCK:
+        if host not in LIMITERS:
+            LIMITERS[host] = RateLimiter(host)
+        return LIMITERS[host]
+
+def get_request_rates():
+    '''Current requests per second allowed for each host seen so far.
+
+    Returns
+    -------
+    dict
+        host: rate (e.g. {"www.allrecipes.com": 6.5})
+    '''
+    with SESSION_LOCK:
+        return {host: round(limiter.current_rate(), 2) for host, limiter in LIMITERS.items()}
+
+def retry_after_seconds(response):
+    '''Read the Retry-After header of a response as seconds, None
+    if it is missing or unreadable.'''
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try: # the header can also be an HTTP date
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def send_request(method, url, session=None, **kwargs):
+    '''Send a request with the request policy: per-host rate limit,
+    timeouts on every call, jittered exponential backoff retries for
+    GETs, and a per-host circuit breaker.
+
+    Parameters
+    ----------
+    method: string
+        HTTP method (e.g. "GET", "PUT")
+    url: string
+        the url to request
+    session: requests.Session
+        session to send with, the shared session for the host if None
+    **kwargs:
+        passed on to session.request (json, headers, ...)
+
+    Returns
+    -------
+    requests.Response
+        the response, never a 5xx
+
+    Raises
+    ------
+    CircuitOpenError
+        the host is cut off
+    requests.RequestException
+        timeouts, connection errors, or a 5xx once retries run out
+    '''
+    if session is None:
+        session = get_session(url)
+    host = urlparse(url).netloc
+    breaker = get_breaker(host)
+    limiter = get_limiter(host)
+    kwargs.setdefault("timeout", REQUEST_TIMEOUT)
+
+    attempts = 1
+    if method.upper() == "GET":
+        attempts += RETRY_ATTEMPTS
+
+    for attempt in range(attempts):
+        breaker.before_request()
+        limiter.acquire()
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            breaker.record_failure()
+            if attempt == attempts - 1:
+                raise
+        else:
+            if response.status_code in THROTTLE_STATUSES:
+                limiter.record_throttle(retry_after_seconds(response)) # next acquire waits out Retry-After
+            elif response.status_code not in RETRY_STATUSES: # only healthy responses raise the rate
+                limiter.record_success()
+            if response.status_code not in RETRY_STATUSES:
+                breaker.record_success()
+                return response
+            if response.status_code != 429: # throttled is not down
+                breaker.record_failure()
+            if attempt == attempts - 1:
+                response.raise_for_status()
+        time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt)) # full jitter so threads don't retry in lockstep
+
+def pace_token_request(url, headers, body):
+    '''OAuth2Session hook run before a token request: wait on the
+    host's rate limiter like send_request does.'''
+    get_limiter(urlparse(url).netloc).acquire()
+    return url, headers, body
+
+def record_token_response(response):
+    '''OAuth2Session hook run on a token response: adjust the host's
+    rate like send_request does.'''
+    limiter = get_limiter(urlparse(response.url).netloc)
+    if response.status_code in THROTTLE_STATUSES:
+        limiter.record_throttle(retry_after_seconds(response))
+    elif response.status_code not in RETRY_STATUSES:
+        limiter.record_success()
+    return response
+
+def pace_token_requests(oauth):
+    '''Make the token requests of an OAuth2Session (fetch_token and
+    the automatic refresh), which don't go through send_request, use
+    the rate limiter too.
+
+    Parameters
+    ----------
+    oauth: OAuth2Session
+        the session to hook
+
+    Returns
+    -------
+    OAuth2Session
+        the same session
+    '''
+    for hook_type in ["access_token_request", "refresh_token_request"]:
+        oauth.register_compliance_hook(hook_type, pace_token_request)
+    for hook_type in ["access_token_response", "refresh_token_response"]:
+        oauth.register_compliance_hook(hook_type, record_token_response)
+    return oauth
 
 ### CACHING ###
 def load_cache(cache_fname):
@@ -495,12 +1535,164 @@ def load_cache(cache_fname):
         cache_file_contents = cache_file.read()
         cache = json.loads(cache_file_contents)
         cache_file.close()
-    except:
+    except FileNotFoundError:
+        cache = {}
+    except ValueError: # unreadable, keep it aside instead of overwriting it with an empty cache
+        cache_file.close()
+        os.replace(cache_fname, cache_fname + ".corrupt")
+        print("[Error]", cache_fname, "could not be read, moved to", cache_fname + ".corrupt", file=sys.stderr)
         cache = {}
     return cache
 
+def open_cache(namespace, cache_fname, upgrade=None):
+    '''Open one of the caches in CACHE_DB. Nothing is read until the
+    cache is first used (see SQLiteCache.open), so this is instant
+    however big the cache is. The first time, the entries of its old
+    JSON cache file are copied in; the JSON file is left where it is.
+
+    Parameters
+    ----------
+    namespace: string
+        which cache to open (e.g. "recipes", "kroger")
+    cache_fname: string or None
+        the JSON file this cache used to live in, None if it never had one
+    upgrade: function or None
+        applied once to every entry, see SQLiteCache
+
+    Returns
+    -------
+    SQLiteCache
+        the opened cache
+    '''
+    cache = SQLiteCache(CACHE_DB, namespace, CACHE_TTL.get(namespace), CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_BODY_FIELD.get(namespace), cache_fname, upgrade)
+    with FLUSH_LOCK:
+        FLUSH_CACHES.append(cache)
+    start_cache_flusher()
+    return cache
+
+def flush_caches():
+    '''Write every pending cache entry: the SQLite caches and any JSON
+    cache files marked with save_cache_later. A cache that can't be
+    written (e.g. the database is locked) is reported and kept pending
+    for the next flush; the others are still written.'''
+    with FLUSH_LOCK:
+        caches = list(FLUSH_CACHES)
+        json_files = dict(FLUSH_JSON)
+        FLUSH_JSON.clear()
+    for cache in caches:
+        try:
+            cache.flush() # keeps its entries pending if it fails
+        except Exception as err:
+            print("[Error] Could not write the", cache.namespace, "cache:", err, file=sys.stderr)
+    for cache_fname, cache in json_files.items():
+        try:
+            save_cache(cache, cache_fname)
+        except Exception as err:
+            print("[Error] Could not write", cache_fname + ":", err, file=sys.stderr)
+            with FLUSH_LOCK:
+                FLUSH_JSON.setdefault(cache_fname, cache) # unless a newer version is already waiting
+
+def cache_flusher_loop():
+    last_prune = time.time()
+    while True:
+        time.sleep(CACHE_FLUSH_INTERVAL)
+        flush_caches()
+        if time.time() - last_prune > CACHE_PRUNE_INTERVAL: # long-running jobs drop expired entries too
+            last_prune = time.time()
+            with FLUSH_LOCK:
+                caches = list(FLUSH_CACHES)
+            for cache in caches:
+                try:
+                    cache.prune()
+                except Exception as err: # try again at the next interval
+                    print("[Error] Could not prune the", cache.namespace, "cache:", err, file=sys.stderr)
+
+def cache_stats():
+    '''Hit, miss and eviction counters of every open SQLite cache.
+
+    Returns
+    -------
+    dict
+        namespace: counters (see SQLiteCache.get_stats)
+    '''
+    with FLUSH_LOCK:
+        caches = list(FLUSH_CACHES)
+    return {cache.namespace: cache.get_stats() for cache in caches}
+
+def compression_report():
+    '''On-disk compression of every open SQLite cache.
+
+    Returns
+    -------
+    dict
+        namespace: {"raw bytes", "stored bytes", "ratio"}
+    '''
+    with FLUSH_LOCK:
+        caches = list(FLUSH_CACHES)
+    return {cache.namespace: cache.compression_report() for cache in caches}
+
+def check_cache_migration():
+    '''Upgrade old recipe caches in a temporary directory and check
+    that the pages come out as entry dicts: a cache_recipes.json with
+    the pages saved as bare html strings, and a cache.sqlite written
+    before compression with the same kind of entries.
+
+    Returns
+    -------
+    list
+        descriptions of what went wrong, empty if nothing did
+    '''
+    problems = []
+    page = "<html><body>old page</body></html>"
+    search_entry = {"urls": ["https://www.allrecipes.com/recipe/1/x/"], "fetched": time.time()}
+    with tempfile.TemporaryDirectory() as tmp:
+        json_file = os.path.join(tmp, "cache_recipes.json")
+        with open(json_file, "w") as cache_file:
+            json.dump({"https://www.allrecipes.com/recipe/1/x/": page, "https://www.allrecipes.com/search/results/?search=cake": search_entry}, cache_file)
+        old_db = os.path.join(tmp, "old.sqlite")
+        conn = sqlite3.connect(old_db)
+        with conn: # the table as written before compression
+            conn.execute('CREATE TABLE "cache" ("namespace" TEXT NOT NULL, "key" TEXT NOT NULL, "value" TEXT NOT NULL, "stored_at" REAL NOT NULL DEFAULT 0, PRIMARY KEY ("namespace", "key"))')
+            conn.execute("INSERT INTO cache VALUES (?, ?, ?, ?)", ("recipes", "https://www.allrecipes.com/recipe/1/x/", json.dumps(page), time.time()))
+        conn.close()
+
+        for name, cache in [("json migration", SQLiteCache(os.path.join(tmp, "new.sqlite"), "recipes", body_field="text", json_file=json_file, upgrade=upgrade_recipe_entry)),
+                ("old cache.sqlite", SQLiteCache(old_db, "recipes", body_field="text", upgrade=upgrade_recipe_entry))]:
+            try:
+                entry = cache.get("https://www.allrecipes.com/recipe/1/x/")
+                if type(entry) != dict or entry.get("text") != page:
+                    problems.append(name + ": page came out as " + repr(entry))
+                if name == "json migration" and cache.get("https://www.allrecipes.com/search/results/?search=cake") != search_entry:
+                    problems.append(name + ": search entry changed")
+            except Exception as err:
+                problems.append(name + ": " + type(err).__name__ + ": " + str(err))
+            finally:
+                if cache.conn is not None:
+                    cache.conn.close()
+    return problems
+
+def start_cache_flusher():
+    '''Start the background thread that flushes the caches, once, and
+    make sure everything is flushed when the program exits.'''
+    global FLUSHER
+    with FLUSH_LOCK:
+        if FLUSHER is not None:
+            return
+        FLUSHER = threading.Thread(target=cache_flusher_loop, daemon=True) # daemon: exit does not wait for it, flush_caches runs at exit instead
+        FLUSHER.start()
+    atexit.register(flush_caches)
+
+def save_cache_later(cache, cache_fname):
+    '''Mark a JSON cache to be saved by the background flusher instead
+    of writing it on the spot.'''
+    with FLUSH_LOCK:
+        FLUSH_JSON[cache_fname] = cache
+    start_cache_flusher()
+
 def save_cache(cache, cache_fname):
-    ''' Saves the current state of the cache to disk
+    ''' Saves the current state of the cache to disk. The file is
+    written next to the old one and renamed over it, so a crash
+    can't leave a truncated cache behind.
     
     Parameters
     ----------
@@ -511,41 +1703,674 @@ def save_cache(cache, cache_fname):
     -------
     None
     '''
-    cache_file = open(cache_fname, "w")
+    temp_fname = cache_fname + ".tmp"
+    cache_file = open(temp_fname, "w")
     contents_to_write = json.dumps(cache)
     cache_file.write(contents_to_write)
+    cache_file.flush()
+    os.fsync(cache_file.fileno()) # on disk before it replaces the old file
     cache_file.close()
-    time.sleep(.2) # to solve cache issue --> really large
+    os.replace(temp_fname, cache_fname) # atomic: readers see the old file or the new one, never half of one
 
 
-def make_url_request_using_cache(url, cache, cache_fname):
+def upgrade_recipe_entry(entry):
+    '''Turn a recipe cache entry saved as the bare page text (before
+    validators were kept) into an entry dict that is refetched once it
+    is used. Other entries are returned as they are.'''
+    if type(entry) == str:
+        return {"text": entry, "etag": None, "last_modified": None, "fetched": 0}
+    return entry
+
+def make_url_request_using_cache(url, cache):
     '''Check the cache for a saved result for a url.
-    If the result is found, return it. Otherwise send a new 
-    request, save it, then return it.
+    If a fresh result is found, return it. If it is older than
+    CACHE_MAX_AGE, revalidate it with a conditional request: a 304
+    only bumps the fetch time. Otherwise send a new request, save it,
+    then return it. Only a 200 page is saved; an error status (e.g.
+    404) raises requests.HTTPError and leaves the cache as it was.
+
+    Cache entries are dicts with the page "text", its "etag" and
+    "last_modified" validators, and the "fetched" time.
 
     Parameters
     ----------
     url: string
         The URL for the recipe instance
-    cache: json dict
-        A dictionary of param:value pairs
+    cache: SQLiteCache or dict
+        A dictionary of url:entry pairs
     
     Returns
     -------
     string
-        the results of the request as a Python object loaded from JSON
+        the text of the page
     '''
-
-    if (url in cache.keys()): # the url is our unique key
-        return cache[url]
+    entry = upgrade_recipe_entry(cache.get(url)) # the url is our unique key
+
+    if entry is not None:
+        if OFFLINE or time.time() - entry["fetched"] < CACHE_MAX_AGE: # stale pages are still fine offline
+            count_cache("recipe hit")
+            return entry["text"]
+        count_cache("recipe stale")
+    elif OFFLINE: # fail fast instead of going to the network
+        raise CacheMissError(url)
+    else:
+        count_cache("recipe miss")
+
+    conditional = {}
+    if entry is not None:
+        if entry["etag"]:
+            conditional["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            conditional["If-Modified-Since"] = entry["last_modified"]
+
+    response = send_request("GET", url, headers=conditional)
+    if entry is not None and response.status_code == 304: # not modified, keep the saved text
+        new_entry = dict(entry)
+        new_entry["fetched"] = time.time()
+    elif response.status_code != 200:
+        response.raise_for_status() # the recipe fails instead of parsing an error page
+        return response.text # some other 2xx or 3xx, used once but not saved
     else:
-        response = requests.get(url, headers=headers)
-        cache[url] = response.text 
-        save_cache(cache, cache_fname)
-        return cache[url] 
+        new_entry = {
+            "text": response.text,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched": time.time()
+        }
+
+    cache[url] = new_entry # writes only this entry
+    return new_entry["text"]
+
+### EXTRACTORS ###
+
+# html.parser writes these as <br/>, see soup_markup
+VOID_TAGS = ["area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link", "menuitem", "meta", "param", "source", "track", "wbr",
+    "basefont", "bgsound", "command", "frame", "image", "isindex", "nextid", "spacer"]
+
+def lxml_children(node):
+    '''Children of an lxml element as BeautifulSoup sees them: the
+    text between elements is a child too.'''
+    children = []
+    if node.text:
+        children.append(node.text)
+    for child in node:
+        children.append(child)
+        if child.tail:
+            children.append(child.tail)
+    return children
+
+def lxml_string(node):
+    '''BeautifulSoup's .string for an lxml element or text: the text
+    itself, the only text inside an element, or None.'''
+    if type(node) == str:
+        return node
+    if type(node.tag) != str: # comment, BeautifulSoup keeps those as strings
+        return node.text
+    children = lxml_children(node)
+    if len(children) != 1:
+        return None
+    return lxml_string(children[0])
+
+def lxml_next_element(node):
+    '''BeautifulSoup's .next_element: whatever comes right after the
+    start of node in the document.'''
+    children = lxml_children(node)
+    if len(children) > 0:
+        return children[0]
+    while node is not None:
+        if node.tail:
+            return node.tail
+        if node.getnext() is not None:
+            return node.getnext()
+        node = node.getparent()
+    return None
+
+def lxml_has_class(node, class_name):
+    '''BeautifulSoup's class_ match: one of the classes, or all of
+    them in order (e.g. "partial ugc-ratings").'''
+    classes = node.get("class", "").split()
+    return class_name in classes or class_name == " ".join(classes)
+
+def lxml_find_all(node, tag=None, class_name=None):
+    '''BeautifulSoup's find_all(tag, class_=...) on the elements
+    inside node.'''
+    found = []
+    for child in node.iterdescendants(tag):
+        if type(child.tag) == str and (class_name is None or lxml_has_class(child, class_name)):
+            found.append(child)
+    return found
+
+def lxml_find(node, tag=None, class_name=None):
+    '''BeautifulSoup's find, None when nothing matches.'''
+    found = lxml_find_all(node, tag, class_name)
+    if len(found) == 0:
+        return None
+    return found[0]
+
+def soup_markup(node):
+    '''The html BeautifulSoup's str() gives for an element parsed by
+    html.parser.'''
+    if type(node) == str:
+        return node.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    if type(node.tag) != str:
+        return "<!--" + (node.text or "") + "-->"
+    attrs = ""
+    for name, value in node.attrib.items():
+        if name == "class":
+            value = " ".join(value.split())
+        value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        if '"' in value and "'" not in value:
+            attrs += " " + name + "='" + value + "'"
+        else:
+            attrs += " " + name + '="' + value.replace('"', "&quot;") + '"'
+    children = lxml_children(node)
+    if node.tag in VOID_TAGS and len(children) == 0:
+        return "<" + node.tag + attrs + "/>"
+    return "<" + node.tag + attrs + ">" + "".join(soup_markup(child) for child in children) + "</" + node.tag + ">"
+
+class LxmlRecipeExtractor:
+    '''Extracts the same fields as Recipe with lxml: the page is
+    parsed by libxml2 and walked once to find every container by its
+    class, the fields are then read from the small containers. Each
+    extract_* matches the Recipe method of the same name, including
+    .string and str() semantics, so the results match on well-formed
+    pages. Malformed markup (e.g. a <p> left open, a <div> inside a
+    <p>) is repaired differently by libxml2 and html.parser and can
+    give different results; verify-extractors checks the cached pages
+    and EXTRACTOR_SAMPLES.
+
+    Instance Attributes
+    -------------------
+    index: dict
+        class name (one of the Recipe constants): elements with that class, in page order
+    '''
+    CLASSES = [Recipe.NAME_DIV_CLASS, Recipe.RATING_DIV_CLASS, Recipe.NUMRAT_DIV_CLASS, Recipe.DIR_SECTION_CLASS, Recipe.NUMSTEP_SECTION_CLASS,
+        Recipe.REVIEW_DIV_CLASS, Recipe.NUMREV_DIV_CLASS, Recipe.SERV_DIV_CLASS, Recipe.INGREDIENTS_DIV_CLASS, Recipe.NUTRITION_DIV_CLASS]
+
+    def __init__(self, page_text):
+        root = lxml.html.document_fromstring(page_text.encode("utf-8"), parser=lxml.html.HTMLParser(encoding="utf-8"))
+        self.index = {class_name: [] for class_name in self.CLASSES}
+        for node in root.iter(): # the one walk over the whole page
+            classes = node.get("class") if type(node.tag) == str else None
+            if classes is None:
+                continue
+            classes = classes.split()
+            for class_name in set(classes + [" ".join(classes)]):
+                if class_name in self.index:
+                    self.index[class_name].append(node)
+
+    def first(self, class_name):
+        if len(self.index[class_name]) == 0:
+            return None
+        return self.index[class_name][0]
+
+    def record(self):
+        '''field name: value for every field in RECIPE_FIELDS'''
+        return {field: getattr(self, "extract_" + field)() for field in RECIPE_FIELDS}
+
+    def extract_name(self):
+        nam = lxml_string(lxml_next_element(lxml_find(self.first(Recipe.NAME_DIV_CLASS), Recipe.NAME_CONTAINER_TAG)))
+        return str(nam)
+
+    def extract_rating(self):
+        try:
+            rat = (lxml_string(lxml_find(self.first(Recipe.RATING_DIV_CLASS), Recipe.RATING_DIV_CONTAINER, "review-star-text"))
+            .strip()
+            .split(":")[1]
+            .split()[0])
+            return rat
+        except:
+            return "No rating"
+
+    def extract_num_rating(self):
+        try:
+            nums = []
+            nums_2 = []
+            for n in lxml_find_all(self.first(Recipe.NUMRAT_DIV_CLASS), Recipe.NUMRAT_DIV_CONTAINER, "ugc-ratings-item"):
+                nums.append(lxml_string(n).strip().split())
+                for nu in nums:
+                    for num in nu:
+                        if num != "Ratings":
+                            nums_2.append(num)
+            return nums_2[0]
+        except:
+            return 0
+
+    def extract_directions(self):
+        try:
+            dirs = []
+            count = 1
+            for nd in lxml_find_all(self.first(Recipe.DIR_SECTION_CLASS), Recipe.DIR_SECTION_CONTAINER):
+                dirs.append("[" + str(count) + "] " + lxml_string(nd))
+                count += 1
+            return dirs
+        except:
+            return "No Directions"
+
+    def extract_num_steps(self):
+        try:
+            for n in lxml_find_all(self.first(Recipe.NUMSTEP_SECTION_CLASS), class_name=Recipe.NUMSTEP_CONTAINER_CLASS):
+                nbrack = lxml_string(n).strip().split()
+            return nbrack[1]
+        except:
+            return "N/A"
+
+    def extract_review(self):
+        try:
+            revs = []
+            for n in lxml_find_all(self.first(Recipe.REVIEW_DIV_CLASS), Recipe.REVIEW_DIV_CONTAINER, "recipe-review-body--truncated"):
+                revs.append(lxml_string(n).split("\n")[3].strip())
+            return revs
+        except:
+            return "No reviews"
+
+    def extract_num_review(self):
+        try:
+            nums = []
+            nums_2 = []
+            for n in lxml_find_all(self.first(Recipe.NUMREV_DIV_CLASS), Recipe.NUMREV_DIV_CONTAINER, "ugc-ratings-link ugc-reviews-link"):
+                nums.append(lxml_string(n).strip().split())
+                for nu in nums:
+                    for num in nu:
+                        if num != "Reviews":
+                            nums_2.append(num)
+            return nums_2[0]
+        except:
+            return 0
+
+    def extract_servings(self):
+        serving = []
+        for s in self.index[Recipe.SERV_DIV_CLASS]:
+            small = lxml_string(s).strip().replace(" ", "")
+            try:
+                serving.append(int(small))
+            except ValueError:
+                continue
+        return serving[0]
+
+    def extract_ingredients(self):
+        ingrs = []
+        for i in lxml_find_all(self.first(Recipe.INGREDIENTS_DIV_CLASS), Recipe.INGREDIENTS_CONTAINER_TAG, "ingredients-item-name"):
+            try:
+                ingrs.append(lxml_string(i).strip())
+            except:
+                continue
+        return ingrs
+
+    def extract_nutrition(self):
+        try:
+            for n in lxml_find_all(self.first(Recipe.NUTRITION_DIV_CLASS), Recipe.NUTRITION_CONTAINER_TAG, "section-body"):
+                good = soup_markup(n).split("\n")[1].strip()
+                goods = good.split(";")
+                for i in range(len(goods)):
+                    goods[i] = goods[i].strip().capitalize()
+                    if i == len(goods) - 1:
+                        goods[i] = goods[i][:-1]
+            return goods
+        except:
+            return "No nutrition information"
+
+def parse_recipe_html_soup(page_text):
+    '''Extract the recipe fields with BeautifulSoup and the Recipe
+    extract_* methods.'''
+    soup = BeautifulSoup(page_text, "html.parser")
+    recipe = Recipe("", soup)
+    return {field: getattr(recipe, field) for field in RECIPE_FIELDS}
+
+def parse_recipe_html_lxml(page_text):
+    '''Extract the recipe fields with LxmlRecipeExtractor.'''
+    return LxmlRecipeExtractor(page_text).record()
+
+EXTRACTORS = {"soup": parse_recipe_html_soup, "lxml": parse_recipe_html_lxml}
+
+JSONLD_SCRIPT = re.compile(r'<script[^>]*type=["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.IGNORECASE | re.DOTALL)
+# schema.org nutrition key: label used on the page, in the order the page lists them
+JSONLD_NUTRITION = [("proteinContent", "Protein"), ("carbohydrateContent", "Carbohydrates"), ("fatContent", "Fat"),
+    ("cholesterolContent", "Cholesterol"), ("sodiumContent", "Sodium")]
+
+def find_jsonld_recipe(page_text):
+    '''Find the schema.org Recipe object in the page's JSON-LD
+    scripts, without parsing the html around them.
+
+    Returns
+    -------
+    dict or None
+        the Recipe object, None if the page has none
+    '''
+    for match in JSONLD_SCRIPT.finditer(page_text):
+        try:
+            data = json.loads(match.group(1))
+        except ValueError:
+            continue
+        candidates = [data]
+        while len(candidates) > 0:
+            item = candidates.pop(0)
+            if type(item) == list:
+                candidates.extend(item)
+            elif type(item) == dict:
+                types = item.get("@type")
+                if types == "Recipe" or (type(types) == list and "Recipe" in types):
+                    return item
+                candidates.extend(item.get("@graph", []))
+    return None
+
+def format_count(value):
+    '''A count written the way the page shows it (e.g. 1550 -> "1,550").'''
+    return "{:,}".format(int(float(value)))
+
+def parse_recipe_jsonld(page_text):
+    '''Extract the recipe fields from the page's schema.org JSON-LD,
+    in the same formats as Recipe.
+
+    Parameters
+    ----------
+    page_text: string
+        html of a recipe page
+
+    Returns
+    -------
+    dict or None
+        field name: value for every field in RECIPE_FIELDS, None if the
+        page has no usable JSON-LD Recipe (or one shaped differently
+        than expected) and has to be parsed
+    '''
+    ld = find_jsonld_recipe(page_text)
+    if ld is None:
+        return None
+    rating = ld.get("aggregateRating") or {}
+    nutrition = ld.get("nutrition") or {}
+    if type(rating) != dict or type(nutrition) != dict:
+        return None
+    if type(ld.get("recipeIngredient")) != list or type(ld.get("recipeInstructions")) != list: # a string would be read a character at a time
+        return None
+    try:
+        name = html.unescape(ld["name"].strip())
+        ingredients = [html.unescape(ingredient.strip()) for ingredient in ld["recipeIngredient"]]
+        steps = []
+        for step in ld["recipeInstructions"]:
+            if type(step) == dict:
+                step = step["text"]
+            steps.append(html.unescape(step.strip()))
+        recipe_yield = ld["recipeYield"]
+        if type(recipe_yield) == list:
+            recipe_yield = recipe_yield[0]
+        servings = int(re.search(r"\d+", str(recipe_yield)).group())
+    except (KeyError, TypeError, AttributeError): # not enough to make a Recipe, parse the html instead
+        return None
+
+    record = {"name": name, "ingredients": ingredients, "servings": servings}
+    record["directions"] = ["[" + str(count + 1) + "] " + step for count, step in enumerate(steps)]
+    record["num_steps"] = str(len(steps))
+    if len(steps) == 0:
+        record["directions"] = "No Directions"
+        record["num_steps"] = "N/A"
+
+    try: # as the page shows it, e.g. "4.67" or "5"
+        record["rating"] = "{:g}".format(round(float(rating["ratingValue"]), 2))
+    except (KeyError, TypeError, ValueError):
+        record["rating"] = "No rating"
+    try:
+        record["num_rating"] = format_count(rating["ratingCount"])
+    except (KeyError, TypeError, ValueError):
+        record["num_rating"] = 0
+    try:
+        record["num_review"] = format_count(rating["reviewCount"])
+    except (KeyError, TypeError, ValueError):
+        record["num_review"] = 0
+
+    reviews = ld.get("review") or []
+    if type(reviews) == dict:
+        reviews = [reviews]
+    record["review"] = [html.unescape(review["reviewBody"].strip()) for review in reviews if type(review) == dict and type(review.get("reviewBody")) == str]
+    if len(record["review"]) == 0:
+        record["review"] = "No reviews"
+
+    goods = []
+    try: # whole calories like the page shows them, nutrition_plot reads them with int()
+        goods.append(str(round(float(re.sub(r"[^\d.]", "", str(nutrition["calories"]))))) + " calories")
+    except (KeyError, ValueError):
+        pass
+    for key, label in JSONLD_NUTRITION:
+        if nutrition.get(key):
+            goods.append(label + " " + str(nutrition[key]).replace(" ", ""))
+    record["nutrition"] = goods
+    if len(goods) == 0:
+        record["nutrition"] = "No nutrition information"
+    return {field: record[field] for field in RECIPE_FIELDS}
+
+def parse_recipe_html(page_text, extractor="soup", jsonld=True):
+    '''Extract the recipe fields from a recipe page: from its JSON-LD
+    when it has one, otherwise by parsing the html. Only takes and
+    returns plain data, so it can run in a worker process.
+
+    Parameters
+    ----------
+    page_text: string
+        html of a recipe page
+    extractor: string
+        which of EXTRACTORS to use for pages without JSON-LD
+    jsonld: bool
+        False always parses the html
+
+    Returns
+    -------
+    dict
+        field name: value for every field in RECIPE_FIELDS
+    '''
+    if jsonld:
+        record = parse_recipe_jsonld(page_text)
+        if record is not None:
+            return record
+    return EXTRACTORS[extractor](page_text)
+
+def compare_extractors(pages):
+    '''Run every extractor on the same pages, timing them and listing
+    the fields where they disagree. An error is compared by its type.
+    The JSON-LD fast path is timed too, but not compared, since the
+    JSON-LD is worded differently from the page.
+
+    Parameters
+    ----------
+    pages: dict
+        url: html of a recipe page
+
+    Returns
+    -------
+    dict
+        "pages": number of pages, "jsonld pages": number with JSON-LD,
+        "seconds": {extractor: total time},
+        "mismatches": list of {"url", "field", extractor: value}
+    '''
+    seconds = {}
+    records = {}
+    for extractor in EXTRACTORS:
+        start = time.time()
+        records[extractor] = {}
+        for url, page_text in pages.items():
+            try:
+                records[extractor][url] = parse_recipe_html(page_text, extractor)
+            except Exception as err:
+                records[extractor][url] = {field: "error: " + type(err).__name__ for field in RECIPE_FIELDS}
+        seconds[extractor] = round(time.time() - start, 3)
+
+    mismatches = []
+    for url in pages:
+        for field in RECIPE_FIELDS:
+            values = {extractor: records[extractor][url][field] for extractor in EXTRACTORS}
+            if len(set(json.dumps(value) for value in values.values())) > 1:
+                mismatch = {"url": url, "field": field}
+                mismatch.update(values)
+                mismatches.append(mismatch)
+
+    start = time.time()
+    jsonld_pages = sum(parse_recipe_jsonld(page_text) is not None for page_text in pages.values())
+    seconds["jsonld"] = round(time.time() - start, 3)
+    return {"pages": len(pages), "jsonld pages": jsonld_pages, "seconds": seconds, "mismatches": mismatches}
+
+# hand-written pages for verify-extractors: "well_formed" ones must give the same record with every extractor
+EXTRACTOR_SAMPLE_STEPS = '''<!DOCTYPE html><html><head><title>Sample</title></head><body>
+<div class="headline-wrapper"><h1>Cake</h1></div>
+<section class="recipe-instructions recipe-instructions-new component container">%s</section>
+<div class="recipe-meta-item-body">8</div>
+<div class="recipe-shopper-wrapper"><span class="ingredients-item-name">1 cup flour</span></div>
+</body></html>'''
+EXTRACTOR_SAMPLES = [
+    {"name": "well-formed", "well_formed": True, "html": '''<!DOCTYPE html><html><head><title>Sample</title></head><body>
+<div class="headline-wrapper">
+  <h1 class="headline heading-content">Mom&#39;s &amp; Best <em>Cake</em></h1>
+</div>
+<div class="recipe-review-container euDisabled"><span class="review-star-text">Rating: 4.67 stars</span></div>
+<div class="partial  ugc-ratings"><span class="ugc-ratings-item"> 1,550 Ratings </span><a class="ugc-ratings-link ugc-reviews-link"> 1,110 Reviews</a></div>
+<section class="recipe-instructions recipe-instructions-new component container">
+ <ul><li><span class="checkbox-list-text">Step 1</span><p>Preheat &lt;oven&gt;.</p></li>
+ <li><span class="checkbox-list-text">Step 2</span><p>Mix <b>well</b>.</p></li></ul></section>
+<div class="recipes-reviews-container container"><span class="recipe-review-body--truncated">
+a
+b
+  Great cake!   
+</span><!-- c --></div>
+<div class="recipe-meta-item-body"> 1 hr </div><div class="recipe-meta-item-body">
+ 16 </div>
+<div class="recipe-shopper-wrapper"><ul><li><span class="ingredients-item-name">2 cups flour </span></li><li><span class="ingredients-item-name">1 <a href="/t">tempeh</a> x</span></li><li><span class="ingredients-item-name">&frac12; cup water</span></li></ul></div>
+<div class="nutrition-section container"><div class="section-body" data-x='a"b'>
+  412 calories; protein 6.8g; carbohydrates 52.6g; fat 20g <br> sodium &amp; salt.
+ <a href="#">Full</a></div></div>
+</body></html>'''},
+    {"name": "missing sections", "well_formed": True, "html": '<div class="headline-wrapper"><h1></h1><p>x</p></div><div class="recipe-meta-item-body">4</div><div class="recipe-shopper-wrapper"></div>'},
+    {"name": "unclosed p", "well_formed": False, "html": EXTRACTOR_SAMPLE_STEPS % "<p>Step one<p>Step two"},
+    {"name": "div inside p", "well_formed": False, "html": EXTRACTOR_SAMPLE_STEPS % "<p>Step one<div>x</div></p><p>Step two</p>"},
+]
+
+# the same recipe as html and as JSON-LD, see check_jsonld_sample
+EXTRACTOR_JSONLD_SAMPLE = '''<!DOCTYPE html><html><head><title>Sample</title>
+<script type="application/ld+json">[{"@context": "http://schema.org", "@type": "Recipe", "name": "Simple White Cake",
+"recipeYield": "16 servings", "recipeIngredient": ["2 cups flour", "1 cup milk"],
+"recipeInstructions": [{"@type": "HowToStep", "text": "Preheat the oven.\\n"}, {"@type": "HowToStep", "text": "Mix well.\\n"}],
+"aggregateRating": {"@type": "AggregateRating", "ratingValue": "4.666667", "ratingCount": "1550", "reviewCount": 1110},
+"review": [{"@type": "Review", "reviewBody": "Great cake!"}],
+"nutrition": {"@type": "NutritionInformation", "calories": "412.3 calories", "proteinContent": "6.8 g", "fatContent": "20 g"}}]</script>
+</head><body>
+<div class="headline-wrapper"><h1>Simple White Cake</h1></div>
+<div class="recipe-review-container euDisabled"><span class="review-star-text">Rating: 4.67 stars</span></div>
+<div class="partial ugc-ratings"><span class="ugc-ratings-item">1,550 Ratings</span><a class="ugc-ratings-link ugc-reviews-link">1,110 Reviews</a></div>
+<section class="recipe-instructions recipe-instructions-new component container">
+<span class="checkbox-list-text">Step 1</span><p>Preheat the oven.</p>
+<span class="checkbox-list-text">Step 2</span><p>Mix well.</p></section>
+<div class="recipes-reviews-container container"><span class="recipe-review-body--truncated">
+Reviewer
+5 stars
+  Great cake!
+</span></div>
+<div class="recipe-meta-item-body">16</div>
+<div class="recipe-shopper-wrapper"><span class="ingredients-item-name">2 cups flour</span><span class="ingredients-item-name">1 cup milk</span></div>
+<div class="nutrition-section container"><div class="section-body">
+412 calories; protein 6.8g; fat 20g.
+</div></div>
+</body></html>'''
+
+def check_jsonld_sample():
+    '''Check that parse_recipe_jsonld gives the same record as the
+    html extractors on EXTRACTOR_JSONLD_SAMPLE, so code reading the
+    fields (e.g. nutrition_plot) works with either.
+
+    Returns
+    -------
+    list
+        {"extractor", "field", "jsonld", "html"} for every field that differs
+    '''
+    jsonld_record = parse_recipe_jsonld(EXTRACTOR_JSONLD_SAMPLE)
+    mismatches = []
+    for extractor in EXTRACTORS:
+        html_record = parse_recipe_html(EXTRACTOR_JSONLD_SAMPLE, extractor, jsonld=False)
+        for field in RECIPE_FIELDS:
+            if json.dumps(jsonld_record[field]) != json.dumps(html_record[field]):
+                mismatches.append({"extractor": extractor, "field": field, "jsonld": jsonld_record[field], "html": html_record[field]})
+    return mismatches
+
+# EXTRACTOR_JSONLD_SAMPLE with one field shaped differently, (old, new); parse_recipe_jsonld must leave these to the html
+EXTRACTOR_JSONLD_FALLBACKS = {
+    "instructions as one string": ('[{"@type": "HowToStep", "text": "Preheat the oven.\\n"}, {"@type": "HowToStep", "text": "Mix well.\\n"}]', '"Preheat the oven. Mix well."'),
+    "ingredients as one string": ('["2 cups flour", "1 cup milk"]', '"2 cups flour, 1 cup milk"'),
+    "nutrition as a string": ('{"@type": "NutritionInformation", "calories": "412.3 calories", "proteinContent": "6.8 g", "fatContent": "20 g"}', '"412 calories"'),
+    "rating as a list": ('{"@type": "AggregateRating", "ratingValue": "4.666667", "ratingCount": "1550", "reviewCount": 1110}', '["4.666667"]'),
+}
+
+def check_jsonld_shapes():
+    '''Check that parse_recipe_jsonld gives up, without raising, on
+    the EXTRACTOR_JSONLD_FALLBACKS pages, and writes a whole rating
+    the way the page does ("5", not "5.0").
+
+    Returns
+    -------
+    list
+        strings describing each problem, empty if there is none
+    '''
+    problems = []
+    for name, (old, new) in EXTRACTOR_JSONLD_FALLBACKS.items():
+        if old not in EXTRACTOR_JSONLD_SAMPLE:
+            problems.append(name + ": sample has no " + old)
+            continue
+        try:
+            record = parse_recipe_jsonld(EXTRACTOR_JSONLD_SAMPLE.replace(old, new))
+        except Exception as err:
+            problems.append(name + ": " + type(err).__name__ + ": " + str(err))
+            continue
+        if record is not None:
+            problems.append(name + ": read from the JSON-LD as " + repr(record))
+    record = parse_recipe_jsonld(EXTRACTOR_JSONLD_SAMPLE.replace('"ratingValue": "4.666667"', '"ratingValue": "5"'))
+    if record is None or record["rating"] != "5":
+        problems.append("whole rating: came out as " + repr(record and record["rating"]))
+    return problems
+
+def check_extractor_samples():
+    '''Run compare_extractors on EXTRACTOR_SAMPLES.
+
+    Returns
+    -------
+    list
+        {"name", "well_formed", "mismatches"} per sample; mismatches
+        are only a problem on well-formed samples
+    '''
+    results = []
+    for sample in EXTRACTOR_SAMPLES:
+        comparison = compare_extractors({sample["name"]: sample["html"]})
+        results.append({"name": sample["name"], "well_formed": sample["well_formed"], "mismatches": comparison["mismatches"]})
+    return results
+
+def cached_recipe_pages(limit=None):
+    '''The recipe pages in the recipe cache.
+
+    Returns
+    -------
+    dict
+        url: html, at most limit pages
+    '''
+    pages = {}
+    for url in CACHE_DICT.keys():
+        if limit is not None and len(pages) >= limit:
+            break
+        entry = CACHE_DICT.get(url)
+        if type(entry) == dict and type(entry.get("text")) == str and "/recipe/" in url:
+            pages[url] = entry["text"]
+    return pages
+
+def get_parse_executor():
+    '''Return the process pool for parsing, None when PARSE_WORKERS
+    is 0. Workers are spawned rather than forked, since the fetch
+    threads are already running.'''
+    global PARSE_EXECUTOR
+    if PARSE_WORKERS <= 0:
+        return None
+    with SESSION_LOCK:
+        if PARSE_EXECUTOR is None:
+            PARSE_EXECUTOR = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return PARSE_EXECUTOR
 
 def get_recipe_instance(url):
-    '''Make an instance from a recipe URL.
+    '''Make an instance from a recipe URL. The extracted fields are
+    cached in PARSED_DICT with a hash of the page, EXTRACTOR_VERSION,
+    EXTRACTOR and USE_JSONLD, so a page already parsed by this version of the code
+    is not parsed again.
     
     Parameters
     ----------
@@ -557,10 +2382,190 @@ def get_recipe_instance(url):
     instance
         a recipe instance
     '''
-    response = requests.get(url, headers=headers) # include headers in the request
-    url_text = make_url_request_using_cache(url, CACHE_DICT, CACHE_FILE_NAME) # implement caching; recipes only use the regular cache
-    soup = BeautifulSoup(response.text, "html.parser") # convert saved cache data to a BeautifulSoup object
-    return Recipe(url_text, soup) # create an instance of a Recipe
+    url_text = make_url_request_using_cache(url, CACHE_DICT) # implement caching; recipes only use the regular cache
+    page_hash = hashlib.sha1(url_text.encode("utf-8")).hexdigest()
+    parsed = PARSED_DICT.get(url)
+    if parsed is not None and parsed["hash"] == page_hash and parsed["version"] == EXTRACTOR_VERSION and parsed.get("extractor", "soup") == EXTRACTOR and parsed.get("jsonld") == USE_JSONLD:
+        count_cache("parsed hit")
+        return Recipe.from_record(url, parsed["record"])
+    count_cache("parsed miss")
+    parse_executor = get_parse_executor()
+    if parse_executor is None:
+        record = parse_recipe_html(url_text, EXTRACTOR, USE_JSONLD)
+    else: # BeautifulSoup is CPU bound, parse in another process so threads don't wait on the GIL
+        record = parse_executor.submit(parse_recipe_html, url_text, EXTRACTOR, USE_JSONLD).result()
+    record = json.loads(json.dumps(record)) # plain types, NavigableStrings would keep the whole soup alive
+    PARSED_DICT[url] = {"hash": page_hash, "version": EXTRACTOR_VERSION, "extractor": EXTRACTOR, "jsonld": USE_JSONLD, "record": record}
+    return Recipe.from_record(url, record) # create an instance of a Recipe
+
+def get_recipe_executor():
+    '''Return the shared thread pool for recipe pages, creating it
+    with MAX_WORKERS threads the first time.'''
+    global RECIPE_EXECUTOR
+    with SESSION_LOCK:
+        if RECIPE_EXECUTOR is None:
+            RECIPE_EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        return RECIPE_EXECUTOR
+
+def get_search_executor():
+    '''Return the shared thread pool for search results pages.'''
+    global SEARCH_EXECUTOR
+    with SESSION_LOCK:
+        if SEARCH_EXECUTOR is None:
+            SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+        return SEARCH_EXECUTOR
+
+def get_kroger_executor():
+    '''Return the shared thread pool for Kroger product lookups, no
+    bigger than the Kroger connection pool.'''
+    global KROGER_EXECUTOR
+    with SESSION_LOCK:
+        if KROGER_EXECUTOR is None:
+            KROGER_EXECUTOR = ThreadPoolExecutor(max_workers=POOL_MAXSIZE[KROGER_HOST])
+        return KROGER_EXECUTOR
+
+def store_late_recipe(url, query, future):
+    '''Done-callback for a recipe that missed the query deadline:
+    store it in the database once it arrives.'''
+    if future.cancelled() or future.exception() is not None:
+        return # nothing to store, the user never saw it either
+    store_recipe(future.result(), query, url)
+
+def drain_pipeline(url_list, query):
+    '''Run the rest of a recipe pipeline in the background after its
+    deadline, storing the recipes as they finish.'''
+    try:
+        for recipe_pair in recipe_pipeline(url_list, query):
+            pass # recipe_pipeline already stored it
+    except (CacheMissError, CircuitOpenError, requests.RequestException):
+        pass # nobody is waiting on these anymore
+
+def produce_urls(url_list, url_queue):
+    '''Thread body for a recipe pipeline with a deadline: read the
+    urls, which may wait on search pages, into url_queue as (url, None)
+    pairs, then (None, None); an error ends it as (None, error).'''
+    try:
+        for url in url_list:
+            url_queue.put((url, None))
+        url_queue.put((None, None))
+    except Exception as err: # raised again by the reader
+        url_queue.put((None, err))
+
+def iter_url_queue(url_queue):
+    '''Yield the urls put in url_queue by produce_urls.'''
+    while True:
+        url, err = url_queue.get()
+        if err is not None:
+            raise err
+        if url is None:
+            return
+        yield url
+
+def recipe_pipeline(url_list, query, deadline=None, late_urls=None, window=None, failed_urls=None):
+    '''Fetch, parse and store recipes as a stream. Pages are fetched
+    on the shared pool with at most window of them in flight; each
+    recipe is added to the database and yielded as soon as it and
+    every recipe before it are ready, so results stay in order and
+    memory holds only the in-flight items.
+
+    When deadline seconds have passed, the recipes that are done are
+    still yielded in order and the generator stops. The recipes still
+    running are stored when they finish and the urls not started yet
+    are fetched by a background thread, so one slow page can't hold
+    back the others. With a deadline the urls are read on their own
+    thread, so a slow search page can't hold up the stream past it.
+
+    Parameters
+    ----------
+    url_list: list or iterator
+        URLs for recipe pages in allrecipes.com
+    query: string
+        the recipe query the recipes are stored under
+    deadline: float or None
+        seconds before the stream stops, None runs to the end
+    late_urls: list or None
+        if given, urls handed to the background are appended to it
+    window: int or None
+        most pages in flight, 2 * MAX_WORKERS if None
+    failed_urls: list or None
+        if given, a recipe that can't be fetched (retries used up, host
+        down, not cached offline) is skipped and its url appended to
+        it; if None the error is raised
+
+    Yields
+    ------
+    tuple
+        (url, recipe instance)
+    '''
+    started = time.time()
+    executor = get_recipe_executor()
+    if window is None:
+        window = 2 * MAX_WORKERS
+    url_queue = None
+    if deadline is None:
+        urls = iter(url_list)
+    else:
+        url_queue = queue.Queue(maxsize=window) # the reader runs at most a window ahead
+        threading.Thread(target=produce_urls, args=(url_list, url_queue), daemon=True).start()
+        urls = iter_url_queue(url_queue) # what is left of it goes to the background at the deadline
+    in_flight = deque()
+    more_urls = True
+
+    while True:
+        while more_urls and len(in_flight) < window: # top up the window
+            if url_queue is None:
+                try:
+                    url = next(urls) # may wait on a search page
+                except StopIteration:
+                    more_urls = False
+                    break
+            else:
+                try: # wait for a url only when nothing else is running
+                    url, err = url_queue.get(block=len(in_flight) == 0, timeout=max(0, started + deadline - time.time()))
+                except queue.Empty:
+                    break
+                if err is not None:
+                    raise err
+                if url is None:
+                    more_urls = False
+                    break
+            in_flight.append((url, executor.submit(get_recipe_instance, url)))
+        if len(in_flight) == 0:
+            if more_urls: # out of time before the search pages came in
+                threading.Thread(target=drain_pipeline, args=(urls, query)).start()
+            return
+
+        url, future = in_flight[0]
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, started + deadline - time.time())
+        try:
+            recipe = future.result(timeout=timeout)
+        except (CacheMissError, CircuitOpenError, requests.RequestException):
+            if failed_urls is None:
+                raise # errors are raised to the caller like before
+            in_flight.popleft() # one bad page doesn't end the stream
+            failed_urls.append(url)
+            continue
+        except FutureTimeoutError: # out of time: keep what is done, hand the rest to the background
+            finished = deque()
+            for late_url, late_future in in_flight:
+                if late_future.done():
+                    finished.append((late_url, late_future))
+                    continue
+                late_future.add_done_callback(partial(store_late_recipe, late_url, query))
+                if late_urls is not None:
+                    late_urls.append(late_url)
+            if more_urls:
+                threading.Thread(target=drain_pipeline, args=(urls, query)).start()
+            in_flight = finished # yielded below without waiting
+            more_urls = False
+            deadline = None
+            continue
+
+        in_flight.popleft()
+        store_recipe(recipe, query, url)
+        yield url, recipe
 
 def parse_single_from_db(single_from_db):
     '''Parse tuples with single strings from database.
@@ -749,7 +2754,7 @@ def rating_score_plot(recipe_list, num_ratings, num_reviews, rating, num_steps):
     fig.write_html("plot3.html", auto_open=True)
 
 def remove_dupes(dupe): # for ingredient parsing below
-    '''Remove duplicates from a list.
+    '''Remove duplicates from a list, keeping the first of each.
     
     Parameters
     ----------
@@ -761,11 +2766,96 @@ def remove_dupes(dupe): # for ingredient parsing below
     list
         without duplicates
     '''
-    no_duplicates = []
-    for i in dupe:
-        if i not in no_duplicates:
-            no_duplicates.append(i)
-    return no_duplicates
+    return list(dict.fromkeys(dupe)) # dict keys keep their order, one pass instead of a list search per element
+
+class IngredientNormalizer:
+    '''Turns raw ingredient lines (e.g. "2 fluid ounces milk, warm")
+    into search terms (e.g. "milk"). Stopwords are matched as whole
+    words, multi-word ones (e.g. "room temperature") as consecutive
+    words. Every line is normalized once, later calls are looked up.
+
+    Instance Attributes
+    -------------------
+    single: set
+        one-word stopwords
+    phrases: dict
+        first word of a multi-word stopword: the words that follow it, longest first
+    memo: dict
+        raw ingredient line: normalized line, at most INGREDIENT_MEMO_SIZE of them
+    '''
+    def __init__(self, stopwords=INGREDIENT_STOPWORDS, punctuation=INGREDIENT_PUNCTUATION):
+        self.single = set()
+        self.phrases = {}
+        for stopword in stopwords:
+            words = stopword.split()
+            if len(words) == 1:
+                self.single.add(words[0])
+            elif tuple(words[1:]) not in self.phrases.setdefault(words[0], []):
+                self.phrases[words[0]].append(tuple(words[1:]))
+        for rests in self.phrases.values():
+            rests.sort(key=len, reverse=True) # "fluid ounces" before any shorter phrase starting with "fluid"
+        self.delete_punctuation = str.maketrans("", "", "".join(punctuation))
+        self.memo = {}
+
+    def normalize(self, raw):
+        '''Normalize one ingredient line: only the part before the first
+        comma, lower case, without punctuation, numbers or stopwords.
+
+        Parameters
+        ----------
+        raw: string
+            ingredient line (e.g. "1 cup white sugar, divided")
+
+        Returns
+        -------
+        string
+            the remaining words (e.g. "white sugar"), "" if none are left
+        '''
+        normalized = self.memo.get(raw)
+        if normalized is not None:
+            return normalized
+        words = [word.lower().translate(self.delete_punctuation) for word in raw.split(",")[0].split()]
+        kept = []
+        i = 0
+        while i < len(words):
+            word = words[i]
+            matched = 0
+            for rest in self.phrases.get(word, []):
+                if tuple(words[i + 1:i + 1 + len(rest)]) == rest:
+                    matched = 1 + len(rest)
+                    break
+            if matched > 0:
+                i += matched
+                continue
+            if word != "" and word not in self.single and not word.isnumeric():
+                kept.append(word)
+            i += 1
+        normalized = " ".join(kept)
+        if len(self.memo) >= INGREDIENT_MEMO_SIZE:
+            self.memo.clear()
+        self.memo[raw] = normalized
+        return normalized
+
+    def normalize_list(self, ingredients):
+        '''Normalize the ingredients of one recipe, without duplicates.'''
+        return remove_dupes([self.normalize(raw) for raw in ingredients])
+
+    def normalize_batch(self, ingredient_lists):
+        '''Normalize the ingredients of many recipes.
+
+        Parameters
+        ----------
+        ingredient_lists: list
+            one list of raw ingredient lines per recipe
+
+        Returns
+        -------
+        list
+            one list of normalized ingredients per recipe
+        '''
+        return [self.normalize_list(ingredients) for ingredients in ingredient_lists]
+
+INGREDIENT_NORMALIZER = IngredientNormalizer()
 
 def ingredients_parsing(master_ingredients_list):
     '''Takes raw ingredients and removes stopwords. Creates ingredients
@@ -781,61 +2871,7 @@ def ingredients_parsing(master_ingredients_list):
     list
         ingredients in a friendlier format, without stopwords
     '''
-    stopwords = ["teaspoons", "teaspoon", "tablespoons", "tablespoon", "ounces", "ounce", 
-    "fluid ounces", "fluid ounce", "gills", "gill", "cups", "cup", "pints", "pint",  "quarts",
-    "quart", "gallons", "gallon", "pounds", "pound", "grams", "gram", "packages", "package", 
-    "canned", "cans", "can", "inches", "inch", "crumbs", "crumb", "cubes", "cube", "warm", "cold", 
-    "hot", "chilled", "refrigerated", "container", "packed", "pack", "finely", "fine", "chopped",
-    "instant", "mix", "room temperature", "diced", "sliced", "uncooked", "optional", "mashed",
-    "peeled", "bulk", "pureed", "frozen", "ground", "dried", "minced", "cooked", "to", "taste",
-    "boxes", "such", "as" "large", "small", "sheets", "grated", "pinch", "sifted", "lightly", 
-    "light", "dark", "medium", "fresh", "jar", "boxed", "coarsely", "rinsed", "bunch", "freshly",
-    "as", "needed", "bag", "roughly", "very", "thinly", "thin", "cubed", "piece", "matchsticks",
-    "grated", "part", "just", "ripe", "raw", "sprigs", "stalks", "stalk", "store-bought", "serving", 
-    "crushed", "whole", "drained", "sprigs", "sprig", "for", "decoration", "dash", "box", "dry", 
-    "large", "drizzling", "carton", "stalk", "soaked", "granules", "trimmed", "head", "milliliter",
-    "peel", "leaves", "prepared", "garnish", "superfine", "crumbles", "topping"] 
-    # stopwords were derived from looking at many recipes
-
-    stopwords_2 = ["(", ")", "."] # punctuation is treated differently
-
-    ingredients_master = []
-
-    for i in range(len(master_ingredients_list)):
-        ingredients_single = []
-        for block in master_ingredients_list[i]:  # for ingredient long string in ingredient list 
-            a = block.split(",")[0]
-            b = a.split()
-
-            new_string = ""
-            ns = ""
-            for c in b: # for word in reduced ingredient string "b"
-                c_copy = c.lower() # just in case some ingredients are capitalized
-
-                for m in stopwords_2: # always get rid of punctuation in stopwords2
-                    c_copy = c_copy.replace(m, "")
-
-                for m in stopwords: # get rid of words only in complete matches --> so no "can" taken from "pecans"
-                    if m == c_copy:
-                        c_copy = c_copy.replace(m, "")
-
-                    # c_copy = c_copy.replace(m, "")
-
-                if c_copy.isnumeric() == True:
-                    c_copy = ""
-                
-                if c_copy == "":
-                    continue
-
-                new_string += " " + c_copy
-                ns = new_string.strip()
-
-            ingredients_single.append(ns)
-
-        ingredients_single = remove_dupes(ingredients_single)
-        ingredients_master.append(ingredients_single)
-            
-    return(ingredients_master)
+    return INGREDIENT_NORMALIZER.normalize_batch(master_ingredients_list)
 
 def allergen_plot(recipe_list, cleaned_ingredients_list):
     '''Creates a stacked bar plot of common allergens in recipes, 
@@ -1001,9 +3037,151 @@ def token_saver(token):
     None
     '''
     CACHE_DICT_S["token"] = token
-    with open(CACHE_FILE_S, "w") as outfile:
-        outfile.write(json.dumps(CACHE_DICT_S, indent=2))
-    outfile.close()
+    save_cache_later(CACHE_DICT_S, CACHE_FILE_S) # written by the cache flusher
+
+def count_cache(event):
+    '''Add one to a cache counter in CACHE_STATS (e.g. "recipe hit").'''
+    with CACHE_LOCK:
+        CACHE_STATS[event] = CACHE_STATS.get(event, 0) + 1
+
+def compact_kroger_payload(payload):
+    '''Keep only the parts of a /v1/products response that are read:
+    the KROGER_PRODUCT_FIELDS of each product and meta.pagination.limit.
+    Images, fulfillment, aisle and price data are dropped. The result
+    has the same shape, so it can be compacted again without change.
+
+    Parameters
+    ----------
+    payload: dict
+        /v1/products json result
+
+    Returns
+    -------
+    dict
+        the compacted result; error responses are returned as they are
+    '''
+    if type(payload) != dict or type(payload.get("data")) != list:
+        return payload
+    compact = {"data": []}
+    for product in payload["data"]:
+        compact["data"].append({field: product[field] for field in KROGER_PRODUCT_FIELDS if field in product})
+    try:
+        compact["meta"] = {"pagination": {"limit": payload["meta"]["pagination"]["limit"]}}
+    except (KeyError, TypeError):
+        pass
+    return compact
+
+def lookup_kroger_products(oauth, parsed_ingredient_list):
+    '''Find the Kroger product for each search term, from the Kroger
+    cache when possible.
+
+    Parameters
+    ----------
+    oauth: OAuth2Session
+        authorized Kroger session, only used on cache misses
+    parsed_ingredient_list: list
+        ingredients in a friendly format (e.g. "flour")
+
+    Returns
+    -------
+    list
+        /v1/products json results, one per search term, compacted
+        by compact_kroger_payload
+    '''
+    baseurl = "https://api.kroger.com/v1/products"
+    params = {}
+    params["filter.limit"] = 1 # only show one item
+    responses = []
+
+    for product in parsed_ingredient_list:
+        params["filter.term"] = product
+        request_key = construct_unique_key(baseurl, params)
+
+        if request_key in CACHE_DICT_K:
+            count_cache("kroger hit")
+            response = CACHE_DICT_K[request_key]
+        
+        else:
+            count_cache("kroger miss")
+            new_response = send_request("GET", request_key, session=oauth)
+            response = compact_kroger_payload(new_response.json())
+            if new_response.status_code == 200: # an error (e.g. expired token) would stick for a day
+                CACHE_DICT_K[request_key] = response # writes only this entry
+
+        responses.append(response)
+    return responses
+
+def get_kroger_client_session():
+    '''Return a Kroger session authorized with client credentials.
+    It can look up products but not touch a cart, and needs no
+    browser login, so jobs without a user can use it.
+
+    Returns
+    -------
+    OAuth2Session
+        session with a product.compact token
+    '''
+    global KROGER_CLIENT_OAUTH
+    krog_token_url = "https://api.kroger.com/v1/connect/oauth2/token"
+
+    with SESSION_LOCK:
+        if KROGER_CLIENT_OAUTH is None:
+            client = BackendApplicationClient(client_id=client_key)
+            KROGER_CLIENT_OAUTH = pace_token_requests(configure_session(OAuth2Session(client=client, scope=["product.compact"]), KROGER_HOST))
+        oauth = KROGER_CLIENT_OAUTH
+    with KROGER_TOKEN_LOCK: # not SESSION_LOCK, the token request takes it to find the rate limiter
+        if oauth.token.get("expires_at", 0) < time.time() + 60: # no token yet, or about to expire
+            oauth.fetch_token(krog_token_url, auth=HTTPBasicAuth(client_key, client_secret), timeout=REQUEST_TIMEOUT)
+    return oauth
+
+def warm_caches(queries, pages=SEARCH_PAGES, kroger=True):
+    '''Fetch everything a list of queries needs ahead of time: search
+    results, recipe pages and, if kroger is True, the Kroger product
+    for every parsed ingredient. Prints progress per query and the
+    cache hits and misses at the end.
+
+    Parameters
+    ----------
+    queries: list
+        recipe queries
+    pages: int
+        search results pages read per query
+    kroger: bool
+        also look up the Kroger products
+
+    Returns
+    -------
+    dict
+        cache counters from CACHE_STATS for this run, plus "seconds",
+        "caches", "compression" and the request "rates" per host
+    '''
+    started = time.time()
+    CACHE_STATS.clear()
+    if kroger:
+        get_kroger_client_session() # fail early if the credentials are wrong
+
+    for i in range(len(queries)):
+        query = queries[i]
+        query_started = time.time()
+        try:
+            recipes = [pair[1] for pair in recipe_pipeline(iter_recipe_urls(query, pages), query)]
+            terms = []
+            if kroger:
+                oauth = get_kroger_client_session() # renews the token before it expires on long runs
+                terms = remove_dupes([term for parsed in ingredients_parsing([r.ingredients for r in recipes]) for term in parsed])
+                executor = get_kroger_executor()
+                list(executor.map(lambda term: lookup_kroger_products(oauth, [term]), terms))
+        except Exception as err: # keep warming the other queries
+            print("[" + str(i + 1) + "/" + str(len(queries)) + "]", query + ": [Error]", err)
+            continue
+        print("[" + str(i + 1) + "/" + str(len(queries)) + "]", query + ":", len(recipes), "recipes,", len(terms), "products", "(" + str(round(time.time() - query_started, 1)) + "s)")
+
+    stats = dict(CACHE_STATS)
+    stats["seconds"] = round(time.time() - started, 1)
+    stats["caches"] = cache_stats()
+    stats["compression"] = compression_report()
+    stats["rates"] = get_request_rates() # where the limiters settled, lower means the hosts pushed back
+    return stats
 
 def get_kroger_auth(parsed_ingredient_list):
     '''Authenticate using OAuth2 and add recipe ingredients to 
@@ -1019,6 +3197,7 @@ def get_kroger_auth(parsed_ingredient_list):
     string
         the results of the request as a Python object loaded from JSON
     '''
+    global KROGER_OAUTH
     CACHE_DICT_S = load_cache(CACHE_FILE_S) # did not load in main
 
     krog_token_url = "https://api.kroger.com/v1/connect/oauth2/token"
@@ -1031,13 +3210,16 @@ def get_kroger_auth(parsed_ingredient_list):
     scopes = ["profile.compact", "product.compact", "cart.basic:write"]
     extra = {"client_id": client_key, "client_secret": client_secret}
 
-    if "token" in CACHE_DICT_S.keys():
+    if KROGER_OAUTH is not None: # already authorized earlier in this run
+        oauth = KROGER_OAUTH
+
+    elif "token" in CACHE_DICT_S.keys():
         token = CACHE_DICT_S["token"]
-        oauth = OAuth2Session(client_id=client_key, token=token, auto_refresh_url=krog_token_url, auto_refresh_kwargs=extra, token_updater=token_saver)
+        oauth = pace_token_requests(OAuth2Session(client_id=client_key, token=token, auto_refresh_url=krog_token_url, auto_refresh_kwargs=extra, token_updater=token_saver))
 
     ### create refreshable token and save it to cache ###
     else:
-        oauth = OAuth2Session(client_id=client_key, redirect_uri=redirect, scope=scopes)
+        oauth = pace_token_requests(OAuth2Session(client_id=client_key, redirect_uri=redirect, scope=scopes, auto_refresh_url=krog_token_url, auto_refresh_kwargs=extra, token_updater=token_saver))
         authorization_url, state = oauth.authorization_url(krog_auth_url)
 
         flag_launch = True
@@ -1058,32 +3240,15 @@ def get_kroger_auth(parsed_ingredient_list):
         
         print()
         callback = input("Please paste the full callback URL from the browser: ") # user will enter full redirect URI
-        token = oauth.fetch_token(krog_token_url, authorization_response=callback, client_secret=client_secret) # get token
+        token = oauth.fetch_token(krog_token_url, authorization_response=callback, client_secret=client_secret, timeout=REQUEST_TIMEOUT) # get token
         token["expires_in"] = -300 # needs to be negative for refresh
         token_saver(token) # does saving below, defined in function to pass to token refresher
 
-    ### product information from kroger ###
-    baseurl = "https://api.kroger.com/v1/products"
-    params = {}
-    params["filter.limit"] = 1 # only show one item
-    responses = []
-
-    for product in parsed_ingredient_list:
-        params["filter.term"] = product
-        request_key = construct_unique_key(baseurl, params)
+    if KROGER_OAUTH is None:
+        KROGER_OAUTH = configure_session(oauth, KROGER_HOST) # keep-alive pool for product and cart calls
 
-        if request_key in CACHE_DICT_K.keys():
-            response = CACHE_DICT_K[request_key]
-        
-        else:
-            new_response = oauth.get(request_key)
-            CACHE_DICT_K[request_key] = new_response.json()
-            with open(CACHE_FILE_K, "w") as outfile:
-                outfile.write(json.dumps(CACHE_DICT_K, indent=2))
-            outfile.close()
-            response = CACHE_DICT_K[request_key]
-
-        responses.append(response)
+    ### product information from kroger ###
+    responses = lookup_kroger_products(oauth, parsed_ingredient_list)
 
     ### to add to the cart
     baseurl_2 = "https://api.kroger.com/v1/cart/add"
@@ -1110,21 +3275,465 @@ def get_kroger_auth(parsed_ingredient_list):
             list_qu.append(qu)
         
     items_dict["items"] = list_qu
-    oauth.put(url=baseurl_2, json=items_dict, headers={'Content-Type': 'application/json'}) # add items dict to the cart 
+    send_request("PUT", baseurl_2, session=oauth, json=items_dict, headers={'Content-Type': 'application/json'}) # add items dict to the cart 
 
     return responses
 
+### CRAWL QUEUE ###
+def connect_crawl_db(queue_db):
+    '''Open the crawl queue database, creating the table if needed.
+    Several processes share the file, so writers wait for each other
+    instead of failing.'''
+    conn = sqlite3.connect(queue_db, timeout=60)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS "crawl_queue" (
+            "kind" TEXT NOT NULL,
+            "item" TEXT NOT NULL,
+            "query" TEXT NOT NULL,
+            "status" TEXT NOT NULL DEFAULT 'pending',
+            "worker" TEXT,
+            "lease_expires" REAL,
+            "attempts" INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ("kind", "item")
+        );
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS "crawl_queue_status" ON "crawl_queue" ("status", "kind")') # entries are in rowid order within a status and kind
+    return conn
+
+def enqueue_crawl_items(queue_db, kind, items, query=None):
+    '''Add queries or recipe urls to the crawl queue. An item that is
+    already queued (by any worker, for any query) is left alone, which
+    is what keeps recipe pages from being fetched twice.
+
+    Parameters
+    ----------
+    queue_db: string
+        path of the crawl queue database
+    kind: string
+        "query" or "recipe"
+    items: list or iterator
+        queries or recipe urls
+    query: string or None
+        the query recipe urls were found with, queries are their own query
+
+    Returns
+    -------
+    int
+        number of items that were new
+    '''
+    items = list(items) # a generator may download pages, don't hold the write lock meanwhile
+    conn = connect_crawl_db(queue_db)
+    before = conn.total_changes
+    with conn:
+        for item in items:
+            conn.execute("INSERT OR IGNORE INTO crawl_queue (kind, item, query) VALUES (?, ?, ?)", (kind, item, query or item))
+    added = conn.total_changes - before
+    conn.close()
+    return added
+
+def lease_crawl_item(queue_db, worker_id):
+    '''Take the next item off the crawl queue. An item whose lease
+    has expired (its worker crashed or hung) is taken over, or marked
+    failed once it has had CRAWL_MAX_ATTEMPTS leases; otherwise the
+    oldest pending item is taken. Queries go before recipes so new
+    work shows up early.
+
+    Parameters
+    ----------
+    queue_db: string
+        path of the crawl queue database
+    worker_id: string
+        name of the worker taking the lease
+
+    Returns
+    -------
+    tuple or None
+        (kind, item, query), or None if nothing can be leased right now
+    '''
+    conn = connect_crawl_db(queue_db)
+    now = time.time()
+    try:
+        conn.execute("BEGIN IMMEDIATE") # lock out other workers between the select and the update
+        conn.execute('''
+            UPDATE crawl_queue SET status = 'failed', lease_expires = NULL
+            WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?
+        ''', (now, CRAWL_MAX_ATTEMPTS)) # keeps crashing its worker or outrunning the lease
+        row = None
+        for kind in ["query", "recipe"]:
+            row = conn.execute('''
+                SELECT kind, item, query FROM crawl_queue
+                WHERE status = 'leased' AND kind = ? AND lease_expires < ?
+                ORDER BY rowid LIMIT 1
+            ''', (kind, now)).fetchone()
+            if row is None:
+                row = conn.execute('''
+                    SELECT kind, item, query FROM crawl_queue
+                    WHERE status = 'pending' AND kind = ?
+                    ORDER BY rowid LIMIT 1
+                ''', (kind,)).fetchone()
+            if row is not None:
+                break
+        if row is not None:
+            conn.execute('''
+                UPDATE crawl_queue SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1
+                WHERE kind = ? AND item = ?
+            ''', (worker_id, now + CRAWL_LEASE, row[0], row[1]))
+        conn.commit()
+    finally:
+        conn.close()
+    return row
+
+def finish_crawl_item(queue_db, worker_id, kind, item, ok):
+    '''Mark a leased item done, or put it back for another try (failed
+    after CRAWL_MAX_ATTEMPTS). Does nothing if the lease was lost to
+    another worker in the meantime.'''
+    conn = connect_crawl_db(queue_db)
+    with conn:
+        if ok:
+            conn.execute("UPDATE crawl_queue SET status = 'done', lease_expires = NULL WHERE kind = ? AND item = ? AND worker = ?", (kind, item, worker_id))
+        else:
+            conn.execute('''
+                UPDATE crawl_queue SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_expires = NULL
+                WHERE kind = ? AND item = ? AND worker = ?
+            ''', (CRAWL_MAX_ATTEMPTS, kind, item, worker_id))
+    conn.close()
+
+def crawl_queue_counts(queue_db):
+    '''Number of crawl items per status (e.g. {"done": 40, "pending": 2}).'''
+    conn = connect_crawl_db(queue_db)
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM crawl_queue GROUP BY status").fetchall())
+    conn.close()
+    return counts
+
+def retry_crawl_db(function, *args):
+    '''Call a crawl queue function, backing off and trying again while
+    other workers keep the database locked.'''
+    delay = RETRY_BACKOFF
+    while True:
+        try:
+            return function(*args)
+        except sqlite3.OperationalError as err:
+            if "locked" not in str(err) and "busy" not in str(err):
+                raise
+            print("[Error] crawl queue:", err, "- trying again")
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, CRAWL_IDLE_WAIT)
+
+def crawl_worker_loop(queue_db, worker_id, pages):
+    '''Lease and process crawl items until the queue is finished.
+    A query item adds its recipe urls to the queue; a recipe item is
+    fetched, parsed and stored in RESULTS_DB.'''
+    while True:
+        leased = retry_crawl_db(lease_crawl_item, queue_db, worker_id)
+        if leased is None:
+            counts = retry_crawl_db(crawl_queue_counts, queue_db)
+            if counts.get("pending", 0) + counts.get("leased", 0) == 0:
+                return # everything is done or failed
+            time.sleep(CRAWL_IDLE_WAIT) # others hold leases, they may add work or crash
+            continue
+
+        kind, item, query = leased
+        try:
+            if kind == "query":
+                recipe_urls = list(iter_recipe_urls(item, pages)) # download before touching the queue
+                retry_crawl_db(enqueue_crawl_items, queue_db, "recipe", recipe_urls, item)
+            else:
+                store_recipe(get_recipe_instance(item), query, item)
+        except Exception as err: # one bad page should not stop the worker
+            print("[Error]", kind, item, err)
+            retry_crawl_db(finish_crawl_item, queue_db, worker_id, kind, item, False)
+        else:
+            retry_crawl_db(finish_crawl_item, queue_db, worker_id, kind, item, True)
+
+def run_crawl_worker(queue_db, threads, pages):
+    '''Run crawl_worker_loop in several threads, each with its own
+    worker id, and wait for them to finish.
+
+    Parameters
+    ----------
+    queue_db: string
+        path of the crawl queue database
+    threads: int
+        items processed at the same time by this process
+    pages: int
+        search results pages read per query
+
+    Returns
+    -------
+    dict
+        number of crawl items per status at the end
+    '''
+    prefix = socket.gethostname() + "-" + str(os.getpid())
+    workers = []
+    for i in range(threads):
+        worker = threading.Thread(target=crawl_worker_loop, args=(queue_db, prefix + "-" + str(i), pages))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    return crawl_queue_counts(queue_db)
+
+### BATCH ###
+def run_ingest(queries, parallel, pages=SEARCH_PAGES):
+    '''Fetch and store the recipes for several queries at the same time.
+
+    Parameters
+    ----------
+    queries: list
+        recipe queries
+    parallel: int
+        queries run at the same time
+    pages: int
+        search results pages read per query
+
+    Returns
+    -------
+    list
+        one dict per query: {"query", "recipes", "skipped", "error"},
+        skipped lists the recipe urls that could not be fetched
+    '''
+    def ingest_one(query):
+        result = {"query": query, "recipes": 0, "skipped": [], "error": None}
+        try:
+            for recipe_pair in recipe_pipeline(iter_recipe_urls(query, pages), query, failed_urls=result["skipped"]): # recipe_pipeline stores each recipe
+                result["recipes"] += 1
+        except Exception as err: # reported in the output, the other queries keep going
+            result["error"] = type(err).__name__ + ": " + str(err)
+        return result
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        return list(executor.map(ingest_one, queries))
+
+def find_recipe_url(recipe, query):
+    '''Resolve the "recipe" of a cart spec to a recipe url. It can be
+    a url, or a recipe name already in RESULTS_DB; if the name is
+    not there and a query is given, the query is ingested first.'''
+    if recipe.startswith("https://"):
+        return recipe
+    query_url = "SELECT url FROM recipes WHERE recipe_name = ?"
+    for attempt in range(2):
+        conn = connect_results_db()
+        row = conn.execute(query_url, (recipe,)).fetchone()
+        conn.close()
+        if row is not None:
+            return row[0]
+        if query is None or attempt == 1:
+            break
+        for recipe_pair in recipe_pipeline(iter_recipe_urls(query), query):
+            pass # stores the query's recipes, then look again
+    raise KeyError("recipe not found: " + recipe)
+
+def run_carts(cart_specs):
+    '''Build Kroger carts from a list of cart specs, without prompts.
+    Each spec is a dict with the "recipe" (url or name), an optional
+    "query" to find it with, and the "owned" ingredients, written as
+    they appear in the recipe, that should not be bought. Needs a
+    Kroger token saved by a previous interactive login.
+
+    Parameters
+    ----------
+    cart_specs: list
+        cart spec dicts
+
+    Returns
+    -------
+    list
+        one dict per spec: {"recipe", "url", "added", "not_found", "error"}
+    '''
+    if "token" not in load_cache(CACHE_FILE_S):
+        raise KeyError("no Kroger login saved in " + CACHE_FILE_S + ", log in once with the interactive program")
+
+    results = []
+    for spec in cart_specs:
+        result = {"recipe": spec.get("recipe"), "url": None, "added": [], "not_found": [], "error": None}
+        try:
+            result["url"] = find_recipe_url(spec["recipe"], spec.get("query"))
+            ingr = get_recipe_instance(result["url"]).ingredients
+            owned = spec.get("owned", [])
+            cart_list = [i for i in ingr if i not in owned]
+            parsed_cart_list = ingredients_parsing([cart_list])
+            kroger_products = get_kroger_auth(parsed_cart_list[0])
+            store_cart_products(kroger_products, parsed_cart_list[0], ingr)
+            for term, product in zip(parsed_cart_list[0], kroger_products):
+                if len(product.get("data") or []) > 0:
+                    result["added"].append(term)
+                else:
+                    result["not_found"].append(term)
+        except Exception as err: # reported in the output, the other carts keep going
+            result["error"] = type(err).__name__ + ": " + str(err)
+        results.append(result)
+    return results
+
+def benchmark_recipe_memory(urls, count):
+    '''Measure the memory held by count recipe instances, made from
+    the cached pages of urls (repeated as needed), as a crawl keeps
+    them. The caches are warmed first so only the recipes are counted.
+
+    Parameters
+    ----------
+    urls: list
+        cached recipe page urls
+    count: int
+        recipes to make
+
+    Returns
+    -------
+    dict
+        "recipes", "bytes" and "bytes per recipe"
+    '''
+    for url in urls: # fill the caches outside the measurement
+        get_recipe_instance(url)
+    flush_caches() # pending entries would be shared between recipes, making them look smaller
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    recipes = [get_recipe_instance(urls[i % len(urls)]) for i in range(count)]
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    return {"recipes": len(recipes), "bytes": held, "bytes per recipe": held // max(len(recipes), 1)}
+
 ##########################
 #########  MAIN ##########
 ##########################
 
 if __name__ == "__main__":
-    # Load the cache, save in global variable
-    CACHE_DICT = load_cache(CACHE_FILE_NAME)
-    CACHE_DICT_K = load_cache(CACHE_FILE_K)
+    parser = argparse.ArgumentParser(description="Allrecipes to Kroger Cart")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="number of recipe pages fetched at the same time")
+    parser.add_argument("--deadline", type=float, default=QUERY_DEADLINE, help="seconds to wait for a query's recipes, 0 waits for all of them")
+    parser.add_argument("--parse-workers", type=int, default=PARSE_WORKERS, help="processes parsing recipe pages, 0 parses in the fetch threads")
+    parser.add_argument("--pages", type=int, default=SEARCH_PAGES, help="search results pages to read per query")
+    parser.add_argument("--target", type=int, default=None, help="stop after this many recipes per query")
+    parser.add_argument("--search-ttl", type=float, default=SEARCH_CACHE_TTL, help="seconds a cached list of search results is used")
+    parser.add_argument("--offline", action="store_true", help="serve recipes only from the cache, never the network")
+    parser.add_argument("--cache-entries", type=int, default=CACHE_MAX_ENTRIES, help="most entries per cache kept in memory")
+    parser.add_argument("--cache-bytes", type=int, default=CACHE_MAX_BYTES, help="most bytes per cache kept in memory")
+    parser.add_argument("--extractor", choices=sorted(EXTRACTORS), default=EXTRACTOR, help="how recipe pages are parsed")
+    parser.add_argument("--no-jsonld", action="store_true", help="parse recipe pages even when they have schema.org JSON-LD")
+    parser.add_argument("--queue-db", default=CRAWL_DB, help="crawl queue database shared by crawl workers")
+    parser.add_argument("--results-db", default=RESULTS_DB, help="database the recipes are stored in, shared by crawl workers")
+    subparsers = parser.add_subparsers(dest="command", help="run a job instead of the interactive program")
+    enqueue_parser = subparsers.add_parser("crawl-enqueue", help="add recipe queries to the crawl queue")
+    enqueue_parser.add_argument("queries_file", help="text file with one recipe query per line")
+    subparsers.add_parser("crawl-work", help="crawl queued queries into the results database until the queue is empty")
+    ingest_parser = subparsers.add_parser("ingest", help="store the recipes for a list of queries, prints JSON")
+    ingest_parser.add_argument("queries_file", help="text file with one recipe query per line")
+    ingest_parser.add_argument("--parallel", type=int, default=4, help="queries run at the same time")
+    cart_parser = subparsers.add_parser("cart", help="build Kroger carts from a JSON spec file, prints JSON")
+    cart_parser.add_argument("spec_file", help="JSON list of {\"recipe\", \"query\", \"owned\"} objects")
+    warm_parser = subparsers.add_parser("warm", help="prefetch recipes and Kroger products for a list of queries")
+    warm_parser.add_argument("queries_file", help="text file with one recipe query per line")
+    warm_parser.add_argument("--no-kroger", action="store_true", help="only prefetch recipes, skip the Kroger products")
+    verify_parser = subparsers.add_parser("verify-extractors", help="parse the cached recipe pages with every extractor and compare them")
+    verify_parser.add_argument("--limit", type=int, default=None, help="most pages to compare")
+    subparsers.add_parser("self-check", help="check that old cache files are upgraded correctly")
+    memory_parser = subparsers.add_parser("memory-benchmark", help="measure the memory used by recipes made from the cached pages")
+    memory_parser.add_argument("--recipes", type=int, default=5000, help="recipes to make")
+    args = parser.parse_args()
+    if lxml is None and (args.extractor == "lxml" or args.command == "verify-extractors"):
+        parser.error("the lxml extractor needs the lxml package (pip install lxml)")
+    EXTRACTOR = args.extractor
+    USE_JSONLD = not args.no_jsonld
+    OFFLINE = args.offline
+    RESULTS_DB = args.results_db
+    SEARCH_CACHE_TTL = args.search_ttl
+    CACHE_MAX_ENTRIES = args.cache_entries
+    CACHE_MAX_BYTES = args.cache_bytes
+    MAX_WORKERS = args.workers
+    PARSE_WORKERS = args.parse_workers
+    POOL_MAXSIZE[ALLRECIPES_HOST] = args.workers + SEARCH_WORKERS # one pooled connection per recipe and search thread
+    query_deadline = args.deadline
+    if query_deadline <= 0:
+        query_deadline = None
+
+    # Open the caches, save in global variable
+    CACHE_DICT = open_cache("recipes", CACHE_FILE_NAME, upgrade_recipe_entry)
+    PARSED_DICT = open_cache("parsed", None)
+    CACHE_DICT_K = open_cache("kroger", CACHE_FILE_K, compact_kroger_payload)
 
     create_tables()
 
+    ######### CRAWL #########
+    if args.command == "crawl-enqueue":
+        with open(args.queries_file) as queries_file:
+            queries = [normalize_query(line) for line in queries_file if line.strip() != ""]
+        added = enqueue_crawl_items(args.queue_db, "query", queries)
+        print(added, "new queries added to", args.queue_db)
+        sys.exit()
+
+    ######### BATCH #########
+    # exit codes: 0 every job worked, 1 some jobs failed, 2 bad input
+    if args.command == "ingest" or args.command == "cart":
+        try:
+            with open(args.queries_file if args.command == "ingest" else args.spec_file) as job_file:
+                if args.command == "ingest":
+                    jobs = remove_dupes([normalize_query(line) for line in job_file if line.strip() != ""])
+                else:
+                    jobs = json.load(job_file)
+        except (OSError, ValueError) as err:
+            print(json.dumps({"error": str(err)}))
+            sys.exit(2)
+
+        with contextlib.redirect_stdout(sys.stderr): # keep stdout for the JSON
+            try:
+                if args.command == "ingest":
+                    results = run_ingest(jobs, args.parallel, args.pages)
+                else:
+                    results = run_carts(jobs)
+            except KeyError as err: # no saved Kroger login
+                results = None
+                error = str(err)
+        if results is None:
+            print(json.dumps({"error": error}))
+            sys.exit(2)
+        print(json.dumps(results, indent=2))
+        if any(result["error"] is not None for result in results):
+            sys.exit(1)
+        sys.exit(0)
+
+    ######### WARM #########
+    if args.command == "warm":
+        with open(args.queries_file) as queries_file:
+            queries = remove_dupes([normalize_query(line) for line in queries_file if line.strip() != ""])
+        stats = warm_caches(queries, args.pages, not args.no_kroger)
+        print("Cache warm finished:", stats)
+        sys.exit()
+
+    if args.command == "verify-extractors":
+        comparison = compare_extractors(cached_recipe_pages(args.limit))
+        comparison["samples"] = check_extractor_samples()
+        comparison["jsonld sample mismatches"] = check_jsonld_sample()
+        comparison["jsonld shape problems"] = check_jsonld_shapes()
+        print(json.dumps(comparison, indent=2))
+        if len(comparison["mismatches"]) > 0 or any(sample["well_formed"] and len(sample["mismatches"]) > 0 for sample in comparison["samples"]) or len(comparison["jsonld sample mismatches"]) > 0 or len(comparison["jsonld shape problems"]) > 0:
+            sys.exit(1)
+        sys.exit()
+
+    if args.command == "self-check":
+        problems = check_cache_migration()
+        for problem in problems:
+            print("[Error]", problem)
+        if len(problems) > 0:
+            sys.exit(1)
+        print("Cache migration: ok")
+        sys.exit()
+
+    if args.command == "memory-benchmark":
+        urls = list(cached_recipe_pages())
+        if len(urls) == 0:
+            print("No cached recipe pages, run a query or crawl first")
+            sys.exit(2)
+        print(json.dumps(benchmark_recipe_memory(urls, args.recipes), indent=2))
+        sys.exit()
+
+    if args.command == "crawl-work":
+        counts = run_crawl_worker(args.queue_db, args.workers, args.pages)
+        print("Crawl finished:", counts)
+        print("Caches:", cache_stats())
+        print("Compression:", compression_report())
+        print("Request rates:", get_request_rates())
+        sys.exit()
+
     flag = True # set flag
     flag_a = True # set flag
     flag_c = False # set flag
@@ -1149,93 +3758,46 @@ if __name__ == "__main__":
                 sys.exit()
                 
             else:
-                # build recipe instances from recipe query
-                recipe_dict = build_recipe_url_dict() 
-
-                recipe_instances = []
-                for recipe_url in recipe_dict[recipe_query]:
-                    ins = get_recipe_instance(recipe_url)
-                    recipe_instances.append(ins)
-
                 print("~-" * 37)
                 print("List of", recipe_query.capitalize(), "Recipes (by popularity)") # force all to capitalize for aesthetics 
                 print("~-" * 37)
 
                 count = 1 # set count for list
+                recipe_instances = [] # only the recipes that are shown are kept
+                late_urls = []
+                failed_urls = []
 
-                if len(recipe_instances) == 0:
+                # build recipe instances from recipe query
+                try:
+                    recipe_urls = iter_recipe_urls(recipe_query, args.pages, args.target) # streamed while search pages download
+                    ######### DATABASE PT 1 #########
+                    for recipe_url, recipe in recipe_pipeline(recipe_urls, recipe_query, query_deadline, late_urls, failed_urls=failed_urls): # each recipe is stored before it comes out
+                        if count <= 20: # only show 20 recipes
+                            print("[" + str(count) + "] " + recipe.info())
+                            recipe_instances.append(recipe)
+                            count += 1
+                except CacheMissError as miss: # only in offline mode, the search results aren't cached
+                    print("[Error] Not in the cache (offline mode):", miss)
+                    if len(recipe_instances) == 0:
+                        continue
+                except (CircuitOpenError, requests.RequestException) as err: # search page timed out, retries used up, host down
+                    print("[Error] Could not reach allrecipes:", err)
+                    if len(recipe_instances) == 0:
+                        continue
+
+                if len(failed_urls) > 0:
+                    print(len(failed_urls), "recipes could not be loaded and were skipped")
+
+                if len(recipe_instances) == 0 and len(late_urls) == 0 and len(failed_urls) == 0:
                     print("No recipes related to query")
                     continue
 
-                for recipe in recipe_instances[:20]: # only show 20 recipes
-                    print("[" + str(count) + "] " + recipe.info())
-                
-                    ######### DATABASE PT 1 #########
-                    ### add recipe info to the database
-                    rec_list = []
-                    rec_list.append(str(recipe.name))
-                    rec_list.append(recipe_query)
-                    rec_list.append(recipe_dict[recipe_query][count-1]) # urls from recipe_dict
-                    rec_list.append(int(recipe.num_steps))
-
-                    # directions edge case
-                    directions_str = "" # create a list so the string doesn't get weird going/coming from the db
-                    if recipe.directions == "No Directions":
-                         directions_str += str(recipe.directions) + "; "
-                    else:
-                        for d in recipe.directions:
-                            directions_str += str(d) + "; " # so that I can split the lists by ";" later
-                    directions_str = directions_str[:-2] # to get rid of the last "; "
-                    rec_list.append(directions_str) 
-                        
-                    rec_list.append(str(recipe.rating))
-                    rec_list.append(str(recipe.num_rating))
-                    add_to_recipe_table(rec_list) # creates a table in database
-
-                    ### add ingredient info to the database
-                    ingr_list = []
-                    ingr_list.append(str(recipe.name))
-                    ingr_list.append(recipe_query)
-
-                    ingredients_str = "" # create a list so the string doesn't get weird going/coming from the db
-                    for i in recipe.ingredients:
-                        ingredients_str += str(i) + "; " # so that I can split the lists by ";" later
-                    ingredients_str = ingredients_str[:-2] # to get rid of the last "; "
-                    ingr_list.append(ingredients_str)
-
-                    ingr_list.append(int(recipe.servings))
-
-                    # nutrition edge case
-                    nutrition_str = "" # create a list so the string doesn't get weird going/coming from the db
-                    if recipe.nutrition == "No nutrition information":
-                         nutrition_str += str(recipe.nutrition) + "; "
-                    else:
-                        for n in recipe.nutrition:
-                            nutrition_str += str(n) + "; " # so that I can split the lists by ";" later
-                    nutrition_str = nutrition_str[:-2] # to get rid of the last "; "
-                    ingr_list.append(nutrition_str) 
-
-                    add_to_ingredients_table(ingr_list) # creates a table in database
-
-                    ### add review info to the database
-                    rev_list = []
-                    rev_list.append(str(recipe.name))
-                    rev_list.append(recipe_query)
-
-                    # review edge case
-                    review_str = "" # create a list so the string doesn't get weird going/coming from the db
-                    if recipe.review == "No reviews":
-                         review_str += str(recipe.review) + "; "
-                    else:
-                        for r in recipe.review:
-                            review_str += str(r) + "; " # so that I can split the lists by ";" later
-                    review_str = review_str[:-2] # to get rid of the last "; "
-                    rev_list.append(review_str) 
-
-                    rev_list.append(str(recipe.num_review))
-                    add_to_reviews_table(rev_list) # creates a table in database
-
-                    count += 1
+                if len(recipe_instances) == 0 and len(late_urls) > 0:
+                    print("No recipes were ready in time, they will be saved as they arrive")
+                    continue
+
+                if len(recipe_instances) == 0:
+                    continue
 
                 flag_a = False # input is valid
                 flag_c = True # set flag
@@ -1341,27 +3903,17 @@ if __name__ == "__main__":
                 print()
 
                 # authorizes, finds product upcs, passes to cart
-                kroger_products = get_kroger_auth(parsed_cart_list[0])
+                try:
+                    kroger_products = get_kroger_auth(parsed_cart_list[0])
+                except (CircuitOpenError, requests.RequestException) as err: # timeouts, retries used up, host down
+                    print("[Error] Could not reach Kroger:", err)
+                    continue
 
                 print()
                 print("Success! Your items have been added.")
 
-                for kp in range(len(kroger_products)):
-                    k = kroger_products[kp]
-                    p  = parsed_cart_list[0][kp]
-                    product = Product(json=k)
-                    shop_list = []
-
-                    ######### DATABASE PT 2 #########
-                    # Kroger related items
-                    shop_list.append(str(product.upc))
-                    shop_list.append(p)
-                    shop_list.append(str(ingr))
-                    shop_list.append(str(product.brand))
-                    shop_list.append(str(product.categories))
-                    shop_list.append(str(product.description))
-                    shop_list.append(product.limit)
-                    add_to_cart_list_table(shop_list) # creates a table in database
+                ######### DATABASE PT 2 #########
+                store_cart_products(kroger_products, parsed_cart_list[0], ingr)
 
                 return_flag_x = True
                 while return_flag_x == True: